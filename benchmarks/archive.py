@@ -0,0 +1,262 @@
+"""
+Benchmark of a whole build over large synthetic archives.  For each archive
+size, a site of generated articles is written to a temporary directory and
+built from scratch in a fresh process, timing `update_all_articles`,
+`SiteState` construction, and `deploy_site` split up by the kind of deploy
+task, followed by a deploy with nothing changed.  The peak resident set size of
+the process is recorded after each step.
+
+Deploy tasks are run in this process (``jobs=1``) so that they can be timed
+one by one; ``--jobs`` only affects updating the articles.  Each archive gets
+its own empty cache, so these are cold builds.
+
+With ``--repeat``, each archive is built that many times (each from scratch)
+and the fastest time of each step is kept, which takes out most of the noise.
+
+Results can be saved with ``--save`` and compared against a saved baseline
+with ``--baseline``, which exits with status 1 if anything got slower (or
+bigger) by more than ``--tolerance``, and slower by at least ``--min-seconds``.
+
+Run from the repository root with ``python -m benchmarks.archive``.  This
+needs KaTeX to be installed, as for a real build.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import pathlib
+import random
+import resource
+import sys
+import tempfile
+import time
+
+_ROOT = pathlib.Path(__file__).parents[1]
+
+_WORDS = (
+    "the of and to in is that for it as with was on be by this are or an at"
+    " from which but not have has one all their can more when there so we"
+    " function value series basis vector matrix integer float scope branch"
+    " compiler memory cache layer module type class object method array"
+    " symmetric linear orthogonal complex signed rounding limit quadrant"
+).split()
+_CODE = '''\
+```python
+def function_{i}_{j}(values, scale={j}):
+    """Scale and sum the values."""
+    total = 0
+    for value in values:
+        total += scale * value  # {word}
+    return f"{{total!r}} from {{len(values)}} values"
+```'''
+_INLINE_EQUATION = r"$`\sum_{{k=0}}^{{{i}}} a_{{{j}}} x^k`$"
+_DISPLAY_EQUATION = r"""\[
+    f_{{{i}}}(x) = \int_0^{{{j}}} e^{{-t^2}} \cos(x t)\,\mathrm{{d}}t
+\]"""
+
+
+def _count(rng, density):
+    """A whole number with mean ``density``."""
+    return int(density) + (rng.random() < density % 1)
+
+
+def _sentence(rng, length=12):
+    words = rng.choices(_WORDS, k=length)
+    return ' '.join(words).capitalize() + '.'
+
+
+def _article(rng, i, args):
+    paragraphs = [
+        ' '.join(_sentence(rng) for _ in range(4))
+        for _ in range(args.paragraphs)
+    ]
+    extras = []
+    for j in range(_count(rng, args.code_blocks)):
+        extras.append(_CODE.format(i=i, j=j, word=rng.choice(_WORDS)))
+    for j in range(_count(rng, args.equations)):
+        if rng.random() < 0.75:
+            position = rng.randrange(len(paragraphs))
+            paragraphs[position] += ' ' + _INLINE_EQUATION.format(i=i, j=j)
+        else:
+            extras.append(_DISPLAY_EQUATION.format(i=i, j=j))
+    # The summary is everything before the first heading.
+    body = paragraphs[:1] + ['## ' + _sentence(rng, 4).rstrip('.')]
+    rest = paragraphs[1:] + extras
+    rng.shuffle(rest)
+    return '\n\n'.join(body + rest) + '\n'
+
+
+def generate(root, n_articles, args):
+    """Write a synthetic site of ``n_articles`` articles under ``root``."""
+    rng = random.Random(args.seed)
+    tags = [f"tag-{k}" for k in range(args.tags)]
+    # A few tags are on most articles and most tags are on a few, as usual.
+    weights = [1 / (k + 1) for k in range(args.tags)]
+    start = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+    store = {}
+    for i in range(n_articles):
+        article_id = f"{i:06x}"
+        directory = pathlib.Path('articles', f"article-{i}")
+        (root / directory).mkdir(parents=True)
+        chosen = set()
+        while len(chosen) < min(args.tags_per_article, args.tags):
+            chosen.update(rng.choices(tags, weights))
+        date = start + datetime.timedelta(hours=i * 31 + rng.randrange(24))
+        info = {
+            'id': article_id,
+            'title': f"Article {i}: {_sentence(rng, 5).rstrip('.')}",
+            'date': date.isoformat(timespec='minutes'),
+            'tags': sorted(chosen),
+        }
+        with open(root / directory / '__article__.py', 'w') as file:
+            file.write(repr(info) + '\n')
+        with open(root / directory / 'article.md', 'w') as file:
+            file.write(_article(rng, i, args))
+        store[article_id] = str(directory)
+    with open(root / 'articles.py', 'w') as file:
+        file.write(repr(store) + '\n')
+    os.symlink(_ROOT / 'template', root / 'template')
+
+
+def _peak_rss():
+    """The peak resident set size of this process so far, in KiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, and macOS bytes.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _measure(root, jobs):
+    """Build the site in ``root``, returning the timings and memory use."""
+    os.chdir(root)
+    from lib import cache, hbar
+    for cache_ in cache.caches():
+        cache_.directory = pathlib.Path(root, '.hbar-cache', cache_.name)
+    results = {}
+
+    def step(name, function):
+        start = time.perf_counter()
+        out = function()
+        results[name] = time.perf_counter() - start
+        results[name + ' peak RSS (KiB)'] = _peak_rss()
+        return out
+
+    tasks = collections.defaultdict(float)
+    calls = collections.Counter()
+    run_deploy_task = hbar._run_deploy_task
+
+    def timed_deploy_task(task, state=None):
+        start = time.perf_counter()
+        try:
+            return run_deploy_task(task, state)
+        finally:
+            tasks[task[0].__name__] += time.perf_counter() - start
+            calls[task[0].__name__] += 1
+
+    hbar._run_deploy_task = timed_deploy_task
+    vars = {'force': False, 'jobs': jobs}
+    step('update_all_articles', lambda: hbar.update_all_articles(vars=vars))
+    step('SiteState', lambda: hbar.SiteState(
+        hbar.STORE_FILE, hbar.TEMPLATE_DIRECTORY / hbar.TEMPLATE_HTML))
+    vars['jobs'] = 1
+    step('deploy_site', lambda: hbar.deploy_site(vars=vars))
+    for name, seconds in sorted(tasks.items()):
+        results[f"deploy_site: {name}"] = seconds
+        results[f"deploy_site: {name} calls"] = calls[name]
+    results['deploy_site: other'] = results['deploy_site'] - sum(tasks.values())
+    step('deploy_site, unchanged',
+         lambda: hbar.deploy_site(vars={**vars, 'incremental': True}))
+    return results
+
+
+def _run(n_articles, args):
+    with tempfile.TemporaryDirectory(prefix='hbar-benchmark-') as root:
+        generate(pathlib.Path(root), n_articles, args)
+        # A fresh process for each archive, so the peak RSS is its own.
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=context) as pool:
+            return pool.submit(_measure, root, args.jobs).result()
+
+
+def _format(value):
+    return f"{value:>12}" if isinstance(value, int) else f"{value:>12.3f}"
+
+
+def _best(runs):
+    """The smallest value of each step over several ``runs`` of one archive."""
+    return {name: min(run[name] for run in runs) for name in runs[0]}
+
+
+def _compare(results, baseline, tolerance, min_seconds):
+    """Print how ``results`` compare to ``baseline``, returning the regressions."""
+    regressions = 0
+    print(f"\n{'articles':>8}  {'step':<50} {'baseline':>12} {'now':>12} {'ratio':>7}")
+    for size, steps in results.items():
+        for name, value in steps.items():
+            before = baseline.get(size, {}).get(name)
+            if not before:
+                continue
+            ratio = value / before
+            regressed = ratio > 1 + tolerance
+            if isinstance(value, float):
+                # Tasks that take next to no time are all noise.
+                regressed = regressed and value - before >= min_seconds
+            regressions += regressed
+            print(f"{size:>8}  {name:<50} {_format(before)} {_format(value)}"
+                  f" {ratio:>6.2f}x{' !' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--articles', type=int, nargs='+', default=[10, 100, 1_000])
+    parser.add_argument('--tags', type=int, default=50,
+                        help="Number of distinct tags in the archive.")
+    parser.add_argument('--tags-per-article', type=int, default=3)
+    parser.add_argument('--paragraphs', type=int, default=8,
+                        help="Paragraphs of prose in each article.")
+    parser.add_argument('--code-blocks', type=float, default=2,
+                        help="Mean number of code blocks in each article.")
+    parser.add_argument('--equations', type=float, default=4,
+                        help="Mean number of equations in each article.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Processes used to update the articles.")
+    parser.add_argument('--save', type=pathlib.Path, metavar='JSON',
+                        help="Write the results to this file.")
+    parser.add_argument('--baseline', type=pathlib.Path, metavar='JSON',
+                        help="Compare the results against this file.")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Fractional slow-down counted as a regression.")
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help="Smallest slow-down in seconds counted as a regression.")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Builds of each archive, keeping the fastest.")
+    args = parser.parse_args()
+    results = {}
+    for n_articles in args.articles:
+        steps = _best([_run(n_articles, args) for _ in range(args.repeat)])
+        results[str(n_articles)] = steps
+        print(f"{n_articles} articles:")
+        for name, value in steps.items():
+            print(f"    {name:<50} {_format(value)}")
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump({'config': {key: value for key, value in vars(args).items()
+                                  if key not in ('save', 'baseline')},
+                       'results': results},
+                      file, indent=1, default=str)
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        if _compare(results, baseline, args.tolerance, args.min_seconds):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark of the fenced-code preprocessor in `lib.highlight` on large
+synthetic documents, against the line-popping implementation it replaced.
+Highlighting itself is replaced by a trivial function, so only the scanning
+is timed.
+
+Run from the repository root with ``python -m benchmarks.codeblock``.
+"""
+
+import argparse
+import timeit
+
+import markdown
+
+from lib import highlight
+
+
+class ReferenceCodeBlock(highlight.CodeBlock):
+    def run(self, lines):
+        out, lines = [], list(reversed(lines))
+        while lines:
+            line = lines.pop()
+            start_match = self._start.match(line)
+            if not start_match:
+                out.append(line)
+                continue
+            first_line = line
+            config = self._config.match(self._start.sub('', line))
+            language = config.group('language') or 'text'
+            code = []
+            while True:
+                if not lines:
+                    out.append(first_line)
+                    lines = list(reversed(code))
+                    break
+                line = lines.pop()
+                if self._end.search(line):
+                    code.append(self._end.sub('', line))
+                    html = highlight.tohtml('\n'.join(code), language)
+                    out.append(self.md.htmlStash.store(html))
+                    break
+                code.append(line)
+        return out
+
+
+def _document(n_lines, unterminated):
+    """
+    About ``n_lines`` of prose with a fenced block every 50 lines.  If
+    ``unterminated`` is set, the last ``unterminated`` fences are never
+    closed, which made the old implementation quadratic.
+    """
+    block = ["Some prose about the code below, with `inline` code."] * 40
+    block += ["```python", "def f(x):", "    return x + 1", "```", ""] * 2
+    lines = (block * (n_lines // len(block) + 1))[:n_lines]
+    lines += ["```python", "never closed"] * unterminated
+    return lines
+
+
+def _run(processor, lines):
+    processor.md.htmlStash.reset()
+    return processor.run(list(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, nargs='+',
+                        default=[1_000, 10_000, 100_000])
+    parser.add_argument('--unterminated', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    # Only the scanning is under test here.
+    highlight.tohtml = lambda code, language, start_line=1: code
+    md = markdown.Markdown()
+    processors = {
+        'reference': ReferenceCodeBlock(md),
+        'current': highlight.CodeBlock(md),
+    }
+    print(f"{'lines':>8} {'unclosed':>8} {'reference (s)':>14}"
+          f" {'current (s)':>12} {'speed-up':>9}")
+    for n_lines in args.lines:
+        for unterminated in (0, args.unterminated):
+            lines = _document(n_lines, unterminated)
+            outputs = [_run(processor, lines) for processor in processors.values()]
+            if outputs[0] != outputs[1]:
+                raise AssertionError("preprocessors disagree")
+            times = [
+                min(timeit.repeat(lambda: _run(processor, lines),
+                                  number=1, repeat=args.repeat))
+                for processor in processors.values()
+            ]
+            print(f"{n_lines:>8} {unterminated:>8} {times[0]:>14.4f}"
+                  f" {times[1]:>12.4f} {times[0] / times[1]:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
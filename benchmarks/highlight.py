@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of the token formatter in `lib.highlight`, against the
+line-by-line, list-concatenating implementation it replaced.
+
+Run from the repository root with ``python -m benchmarks.highlight``.
+"""
+
+import argparse
+import html
+import re
+import timeit
+
+import pygments.lexers
+from pygments.formatters.html import escape_html
+
+from lib import highlight
+
+_SAMPLE = '''\
+class Accumulator:
+    """Sum things up, one at a time."""
+    def __init__(self, start=0):
+        self.total = start  # running total
+
+    def add(self, *values, scale=1.0):
+        for value in values:
+            self.total += scale * value
+        return f"{self.total!r} <= {len(values)} values & more"
+'''
+
+
+def _reference_span(class_, code):
+    if not code:
+        return []
+    if not class_:
+        return [code]
+    return ['<span class="{}">'.format(class_), code, '</span>']
+
+
+def _reference_format_lines(tokens):
+    line = []
+    for token, text in tokens:
+        class_ = highlight._token_to_class(token)
+        escaped = escape_html(text).split('\n')
+        if len(escaped) == 1:
+            line += _reference_span(class_, escaped[0])
+            continue
+        first, *middle, last = escaped
+        yield "".join(line + _reference_span(class_, first))
+        yield from ("".join(_reference_span(class_, mid)) for mid in middle)
+        line = _reference_span(class_, last)
+    if line:
+        yield "".join(line)
+
+
+_SPAN = re.compile(r'<span class="([^"]*)">(.*?)</span>|([^<]+)')
+
+
+def _classified(lines):
+    """The text of formatted lines, with the CSS class of every character."""
+    out = []
+    for line in lines:
+        for match in _SPAN.finditer(line):
+            class_, text = (match[1], match[2]) if match[2] else ('', match[3])
+            out.extend((class_, char) for char in html.unescape(text))
+        out.append(('', '\n'))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, nargs='+',
+                        default=[100, 1_000, 10_000, 100_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    lexer = pygments.lexers.get_lexer_by_name('python')
+    sample = _SAMPLE.splitlines(keepends=True)
+    print(f"{'lines':>8} {'reference (s)':>14} {'current (s)':>12} {'speed-up':>9}")
+    for n_lines in args.lines:
+        code = "".join(sample[i % len(sample)] for i in range(n_lines))
+        tokens = list(lexer.get_tokens(code))
+        reference = '\n'.join(_reference_format_lines(tokens))
+        current, _ = highlight._format(tokens)
+        if (_classified(reference.split('\n'))
+                != _classified(current.split('\n'))):
+            raise AssertionError("formatters disagree on the highlighted text")
+        times = [
+            min(timeit.repeat(lambda: '\n'.join(_reference_format_lines(tokens)),
+                              number=1, repeat=args.repeat)),
+            min(timeit.repeat(lambda: highlight._format(tokens),
+                              number=1, repeat=args.repeat)),
+        ]
+        print(f"{n_lines:>8} {times[0]:>14.4f} {times[1]:>12.4f}"
+              f" {times[0] / times[1]:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
 import functools
+import os
 import sys
-from lib import hbar
+from lib import hbar, minify
 
 
 class AppendOperation(argparse.Action):
@@ -13,10 +15,60 @@ class AppendOperation(argparse.Action):
         namespace.operations.append(operation)
 
 
+def _positive_int(text):
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {text!r}")
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
+
+
 _parser = argparse.ArgumentParser(
         epilog=("At least one operation must be specified."
                 " Operations will be performed in order of specification."))
 _parser.add_argument('--force', action='store_true')
+_parser.add_argument('--incremental', action='store_true',
+                     help="Only rewrite deployed files whose inputs changed.")
+_parser.add_argument('--link', choices=sorted(hbar.ASSET_COPY_FUNCTIONS),
+                     default='copy',
+                     help="How to put unfiltered static files in the deployment."
+                          " Reflinks and hard links fall back to copying where"
+                          " the filesystem does not support them.")
+_parser.add_argument('--fingerprint', action='store_true',
+                     help="Deploy fonts, images and stylesheets under names"
+                          " containing a hash of their contents.")
+_parser.add_argument('--subset-fonts', action='store_true',
+                     help="Deploy woff2 subsets of the Alegreya fonts holding"
+                          " only the characters the site uses (needs the"
+                          " 'fontTools' and 'brotli' modules).")
+_parser.add_argument('--responsive-images', action='store_true',
+                     help="Give article images their sizes, lazy loading and"
+                          " (with the 'Pillow' module) a srcset of smaller"
+                          " copies.")
+_parser.add_argument('--critical-css', action='store_true',
+                     help="Inline the rules of the site's stylesheets that each"
+                          " generated page can use, instead of linking them.")
+_parser.add_argument('--compress', action='store_true',
+                     help="Also write precompressed .gz (and .br, if the"
+                          " 'brotli' module is installed) copies of deployed"
+                          " text files.")
+_parser.add_argument('--minifier', choices=sorted(minify.HTML_MINIFIERS),
+                     default='tokenise',
+                     help="Which HTML minifier to use on deployed pages.")
+_parser.add_argument('--port', type=int, default=8000,
+                     help="Port for '--serve' to listen on (default: 8000).")
+_parser.add_argument('--profile', action='store_true',
+                     help="Time each phase of the build for every article and"
+                          " page, and print a report at the end.  Everything"
+                          " runs in one process.")
+_parser.add_argument('--profile-dump', metavar='FILE',
+                     help="Profile as '--profile' does, and also write a profile"
+                          " to FILE: the phases in speedscope format if it ends"
+                          " in '.json', otherwise cProfile statistics.")
+_parser.add_argument('--jobs', type=_positive_int, default=os.cpu_count(), metavar='N',
+                     help="Number of processes to use (default: CPU count).")
 _parser.add_argument('--update', nargs=1, const=hbar.update_article,
                      metavar='article_dir', dest='operations',
                      action=AppendOperation)
@@ -24,8 +76,18 @@ _parser.add_argument('--update-all', nargs=0, const=hbar.update_all_articles,
                      dest='operations', action=AppendOperation)
 _parser.add_argument('--tidy-up', nargs=0, const=hbar.tidy_up,
                      dest='operations', action=AppendOperation)
+_parser.add_argument('--prune-cache', nargs=0, const=hbar.prune_caches,
+                     dest='operations', action=AppendOperation)
 _parser.add_argument('--deploy', nargs=0, const=hbar.deploy_site,
                      dest='operations', action=AppendOperation)
+_parser.add_argument('--watch', nargs=0, const=hbar.watch,
+                     dest='operations', action=AppendOperation,
+                     help="Update and deploy the site again whenever its"
+                          " sources change, until interrupted.")
+_parser.add_argument('--serve', nargs=0, const=hbar.serve,
+                     dest='operations', action=AppendOperation,
+                     help="Serve a live-reloading preview of the site from"
+                          " memory, without deploying it.")
 
 
 def main():
@@ -34,8 +96,15 @@ def main():
     if not args.operations:
         _parser.print_help()
         sys.exit(1)
-    for operation in args.operations:
-        exit_code += operation(vars=vars(args))
+    if args.profile or args.profile_dump is not None:
+        # Calls in worker processes can't be timed.
+        args.jobs = 1
+        profiler = hbar.profiling(args.profile_dump)
+    else:
+        profiler = contextlib.nullcontext()
+    with profiler:
+        for operation in args.operations:
+            exit_code += operation(vars=vars(args))
     sys.exit(exit_code)
 
 
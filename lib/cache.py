@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+CACHE_DIRECTORY = pathlib.Path(__file__).parents[1] / '.hbar-cache'
+
+_caches = {}
+
+
+class Cache:
+    """
+    A content-addressed store of build artefacts on disk, one file per entry,
+    under ``.hbar-cache/<name>``.  Entries are keyed on a hash of everything
+    that affects their contents, so they never need invalidating; instead the
+    directory is kept below ``max_bytes`` by evicting the least recently used
+    entries, using the file modification time as the access time.
+    """
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.directory = CACHE_DIRECTORY / name
+        self._size = None
+        _caches[name] = self
+
+    @staticmethod
+    def key(*parts):
+        encoded = json.dumps(parts, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.directory / key[:2] / key
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so concurrent builds never see a partial entry.
+        fd, temporary = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        self._size += len(data)
+        if self._size > self.max_bytes:
+            self.prune()
+
+    def _entries(self):
+        if not self.directory.is_dir():
+            return
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime_ns
+
+    def prune(self, max_bytes=None):
+        """
+        Evict least recently used entries until the cache holds at most
+        ``max_bytes`` (by default, three quarters of its limit, so a full cache
+        is not pruned again on the very next write).  Returns the number of
+        entries removed.
+        """
+        if max_bytes is None:
+            max_bytes = 3 * self.max_bytes // 4
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(size for _, size, _ in entries)
+        removed = 0
+        for path, entry_size, _ in entries:
+            if size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            removed += 1
+        self._size = size
+        return removed
+
+
+def caches():
+    return _caches.values()
@@ -0,0 +1,224 @@
+"""
+Per-page stylesheet pruning.  Rules whose selectors can't match anything in a
+page are dropped, and what remains of the site's own stylesheets is inlined
+into the page's `<head>` so that it can render without fetching them.
+
+Matching is deliberately conservative: a selector is kept if every tag name,
+class and id it mentions appears somewhere in the page, regardless of where,
+and pseudo-classes and attribute selectors are assumed to match.
+"""
+
+import re
+
+__all__ = ['used_names', 'prune', 'inline']
+
+# Stylesheets from elsewhere, which can't be pruned, but which are only needed
+# if the page uses a particular class.
+CONDITIONAL_STYLESHEETS = {
+    'katex.min.css': 'katex',
+}
+
+_tag = re.compile(r'<([a-zA-Z][\w-]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+_class = re.compile(r'''\bclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+_id = re.compile(r'''\bid\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+_href = re.compile(r'''\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+_stylesheet_link = re.compile(
+    r'''<link\b(?=[^>]*\brel\s*=\s*["']?stylesheet\b)[^>]*>[ \t]*\n?''')
+
+_comment = re.compile(r'/\*.*?\*/', re.DOTALL)
+_ignored_in_selector = re.compile(r'\[[^\]]*\]|::?[\w-]+(?:\([^)]*\))?')
+_combinator = re.compile(r'\s*[>+~]\s*|\s+')
+_selector_tag = re.compile(r'[a-zA-Z][\w-]*')
+_selector_class = re.compile(r'\.([\w-]+)')
+_selector_id = re.compile(r'#([\w-]+)')
+# At-rules whose blocks contain further rules to be pruned.
+_NESTED_AT_RULES = ('@media', '@supports', '@layer', '@document')
+
+
+def _value(match):
+    return next(group for group in match.groups() if group is not None)
+
+
+def used_names(html):
+    """The sets of tag names, classes and ids that appear in ``html``."""
+    tags, classes, ids = set(), set(), set()
+    for match in _tag.finditer(html):
+        tags.add(match[1].lower())
+        attributes = match[2]
+        if 'class' in attributes:
+            for class_ in _class.finditer(attributes):
+                classes.update(_value(class_).split())
+        if 'id' in attributes:
+            for id_ in _id.finditer(attributes):
+                ids.add(_value(id_))
+    # Elements which the parser inserts even if the source omits them.
+    tags.update(('html', 'head', 'body'))
+    if 'table' in tags:
+        tags.add('tbody')
+    return tags, classes, ids
+
+
+def _may_match(selector, used):
+    tags, classes, ids = used
+    selector = _ignored_in_selector.sub('', selector)
+    for compound in _combinator.split(selector.strip()):
+        tag = _selector_tag.match(compound)
+        if tag is not None and tag[0].lower() not in tags:
+            return False
+        if any(class_ not in classes for class_ in _selector_class.findall(compound)):
+            return False
+        if any(id_ not in ids for id_ in _selector_id.findall(compound)):
+            return False
+    return True
+
+
+def _split_selectors(prelude):
+    """
+    The selectors in a selector list, split on the commas that aren't inside
+    brackets or strings, as in `:is(a, b)` or `[title="a,b"]`.
+    """
+    out = []
+    depth = 0
+    start = 0
+    quote = None
+    position = 0
+    while position < len(prelude):
+        char = prelude[position]
+        if quote is not None:
+            if char == '\\':
+                position += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            out.append(prelude[start:position])
+            start = position + 1
+        position += 1
+    out.append(prelude[start:])
+    return out
+
+
+def _block_end(css, start):
+    """The index just past the '}' matching the '{' at ``start``."""
+    depth = 0
+    position = start
+    quote = None
+    while position < len(css):
+        char = css[position]
+        if quote is not None:
+            if char == '\\':
+                position += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return position + 1
+        position += 1
+    return len(css)
+
+
+def _prune(css, used):
+    out = []
+    position = 0
+    while True:
+        open_ = css.find('{', position)
+        semicolon = css.find(';', position)
+        if semicolon != -1 and (open_ == -1 or semicolon < open_):
+            statement = css[position:semicolon + 1].strip()
+            # `@charset` means nothing inside a <style>, and everything else
+            # that ends without a block (`@import`, ...) has to be kept.
+            if statement and not statement.startswith('@charset'):
+                out.append(statement)
+            position = semicolon + 1
+            continue
+        if open_ == -1:
+            break
+        prelude = css[position:open_].strip()
+        end = _block_end(css, open_)
+        if prelude.startswith(_NESTED_AT_RULES):
+            inner = _prune(css[open_ + 1:end - 1], used)
+            if inner:
+                out.append(prelude + '{' + inner + '}')
+        elif prelude.startswith('@'):
+            out.append(css[position:end].strip())
+        else:
+            selectors = [s for s in _split_selectors(prelude) if _may_match(s, used)]
+            if selectors:
+                out.append(','.join(s.strip() for s in selectors)
+                           + css[open_:end])
+        position = end
+    return ''.join(out)
+
+
+def prune(css, used):
+    """
+    Remove the rules from the stylesheet ``css`` that can't match a page
+    containing the ``used`` names (as returned by `used_names`).
+    """
+    return _prune(_comment.sub('', css), used)
+
+
+def inline(html, load, limit):
+    """
+    Replace the stylesheet links in the page ``html`` by a `<style>` holding
+    only the rules the page can use.  ``load`` takes the URL of a stylesheet
+    and returns its text, or `None` if it isn't one of the site's own.  Links
+    to `CONDITIONAL_STYLESHEETS` are dropped if the page doesn't need them.
+
+    To keep the cascade in the same order, inlining stops at the first link
+    that has to stay, either because the stylesheet is from elsewhere or
+    because more than ``limit`` characters have already been inlined.
+    """
+    used = used_names(html)
+    inlined = []
+    size = 0
+    stopped = False
+    first = None
+
+    def replace(match):
+        nonlocal size, stopped, first
+        href = _href.search(match[0])
+        if href is None:
+            return match[0]
+        url = _value(href)
+        required = CONDITIONAL_STYLESHEETS.get(url.rsplit('/', 1)[-1])
+        if required is not None and required not in used[1]:
+            return ''
+        css = None if stopped or required is not None else load(url)
+        if css is None:
+            stopped = True
+            return match[0]
+        css = prune(css, used)
+        if not css:
+            return ''
+        if size + len(css) > limit:
+            stopped = True
+            return match[0]
+        size += len(css)
+        inlined.append(css)
+        if first is None:
+            first = match.start()
+        return ''
+
+    out = []
+    position = 0
+    for match in _stylesheet_link.finditer(html):
+        out.append(html[position:match.start()])
+        out.append(replace(match))
+        if first == match.start():
+            # Stand-in for where the inlined styles will go.
+            out.append(None)
+        position = match.end()
+    out.append(html[position:])
+    style = '<style>' + ''.join(inlined) + '</style>'
+    return ''.join(style if part is None else part for part in out)
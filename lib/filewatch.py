@@ -0,0 +1,175 @@
+"""
+Waiting for files to change.  On Linux this uses inotify (through `ctypes`, so
+there is no extra dependency), and everywhere else it falls back to polling
+the modification times of every file.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import sys
+import time
+
+__all__ = ['watcher', 'InotifyWatcher', 'PollingWatcher']
+
+# From <sys/inotify.h>.
+_IN_MODIFY = 0x002
+_IN_ATTRIB = 0x004
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM
+         | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF)
+_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Watch files and (recursively) directories with inotify.  Directories
+    created inside watched ones are watched too.
+    """
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = libc.inotify_init1(_IN_CLOEXEC | _IN_NONBLOCK)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._directories = {}
+        self._files = {}
+        for path in paths:
+            path = pathlib.Path(path)
+            if path.is_dir():
+                self._watch_tree(path)
+            else:
+                # Editors often replace files rather than writing to them, so
+                # watch the directory and pick out the file's events.
+                self._files.setdefault(path.parent, set()).add(path.name)
+                self._watch(path.parent)
+
+    def _watch(self, directory):
+        descriptor = self._add_watch(self._fd, os.fsencode(directory), _MASK)
+        if descriptor >= 0:
+            self._directories[descriptor] = directory
+
+    def _watch_tree(self, directory):
+        self._watch(directory)
+        for root, directories, _ in os.walk(directory):
+            for name in directories:
+                self._watch(pathlib.Path(root) / name)
+
+    def _events(self, data):
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield descriptor, mask, name
+
+    def wait(self, timeout=None):
+        """
+        Block until something changes, or for at most ``timeout`` seconds.
+        Returns the set of paths that changed, or None if too much changed to
+        keep track of, in which case the caller should assume that everything
+        did.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 1 << 16)
+            except BlockingIOError:
+                return changed
+            for descriptor, mask, name in self._events(data):
+                if mask & _IN_Q_OVERFLOW:
+                    return None
+                directory = self._directories.get(descriptor)
+                if mask & _IN_IGNORED:
+                    self._directories.pop(descriptor, None)
+                    continue
+                if directory is None:
+                    continue
+                if directory in self._files and name not in self._files[directory]:
+                    continue
+                path = directory / name if name else directory
+                if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._watch_tree(path)
+                changed.add(path)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """Watch files and directories by comparing their stat every so often."""
+    def __init__(self, paths, interval=0.5):
+        self._paths = [pathlib.Path(path) for path in paths]
+        self._interval = interval
+        self._state = self._scan()
+
+    def _scan(self):
+        out = {}
+        for path in self._paths:
+            if path.is_dir():
+                for root, _, files in os.walk(path):
+                    for name in files:
+                        self._stat(pathlib.Path(root) / name, out)
+            else:
+                self._stat(path, out)
+        return out
+
+    @staticmethod
+    def _stat(path, out):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+        out[path] = (stat.st_mtime_ns, stat.st_size)
+
+    def wait(self, timeout=None):
+        """
+        Block until something changes, or for at most ``timeout`` seconds.
+        Returns the set of paths that changed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self._scan()
+            changed = {
+                path for path in state.keys() | self._state.keys()
+                if state.get(path) != self._state.get(path)
+            }
+            self._state = state
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self._interval)
+
+    def close(self):
+        pass
+
+
+def watcher(paths):
+    """The best available watcher of ``paths`` on this system."""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(paths)
@@ -0,0 +1,115 @@
+"""
+Subsetting of the site's text fonts down to the characters that the site
+actually uses, written as woff2.  This needs the optional `fontTools` package,
+along with `brotli` for the woff2 compression.
+"""
+
+import hashlib
+import html
+import io
+import re
+
+try:
+    import fontTools
+    import fontTools.subset
+    import brotli  # noqa: F401 (fontTools needs it to write woff2)
+except ImportError:
+    fontTools = None
+
+from . import cache
+
+__all__ = ['available', 'characters', 'subset', 'rewrite_font_faces']
+
+# Bump whenever the subsetting options change.
+_FORMAT_VERSION = 1
+_cache = cache.Cache('fonts', 32 * 1024 * 1024)
+
+# Always kept, so that small additions to the site (and CSS `content`) don't
+# fall back to another font before the next deploy.
+_BASE_CHARACTERS = frozenset(map(chr, range(0x20, 0x7f)))
+
+_tag = re.compile(r'<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+_font_face = re.compile(r'@font-face\s*\{[^}]*\}')
+_declaration = re.compile(r'\s*([\w-]+)\s*:')
+_url = re.compile(r'''url\(\s*['"]?([^'")?#]+)''')
+
+
+def available():
+    """Whether fonts can be subset in this environment."""
+    return fontTools is not None
+
+
+def characters(texts):
+    """
+    The characters that rendering the HTML (or Markdown) ``texts`` can need,
+    in both cases, since stylesheets may transform them.
+    """
+    out = set(_BASE_CHARACTERS)
+    for text in texts:
+        out.update(html.unescape(_tag.sub(' ', text)))
+    out.update(''.join(out).upper())
+    out.update(''.join(out).lower())
+    out.discard('\n')
+    return ''.join(sorted(out))
+
+
+def _subset(data, characters):
+    options = fontTools.subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    options.name_IDs = ['*']
+    options.notdef_outline = True
+    # FontForge's timestamp table, which fontTools can't subset.
+    options.drop_tables += ['FFTM']
+    font = fontTools.subset.load_font(io.BytesIO(data), options)
+    subsetter = fontTools.subset.Subsetter(options)
+    subsetter.populate(text=characters)
+    subsetter.subset(font)
+    out = io.BytesIO()
+    fontTools.subset.save_font(font, out, options)
+    return out.getvalue()
+
+
+def subset(data, characters):
+    """
+    Subset the font file ``data`` to ``characters``, returning the woff2 file
+    and a key that changes whenever it does.
+    """
+    key = _cache.key(_FORMAT_VERSION, fontTools.version,
+                     hashlib.sha256(data).hexdigest(), characters)
+    out = _cache.get(key)
+    if out is None:
+        out = _subset(data, characters)
+        _cache.put(key, out)
+    return out, key
+
+
+def rewrite_font_faces(css, subsets):
+    """
+    Point each `@font-face` rule in ``css`` that uses a font in ``subsets`` at
+    that font's subset instead of all its original formats.  ``subsets`` maps
+    the name of each original font file, without its extension, to the URL of
+    its subset.
+    """
+    if not subsets:
+        return css
+
+    def replace(match):
+        block = match[0]
+        for url in _url.findall(block):
+            stem = url.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+            if stem in subsets:
+                break
+        else:
+            return block
+        # Everything but the other `src` descriptors is kept.  Splitting on
+        # semicolons also drops the fragments of badly terminated `src` lists.
+        body = block[block.index('{') + 1:-1]
+        kept = [f"src:url('{subsets[stem]}') format('woff2')"]
+        for declaration in body.split(';'):
+            match = _declaration.match(declaration)
+            if match is not None and match[1].lower() != 'src':
+                kept.append(declaration.strip())
+        return '@font-face{' + ';'.join(kept) + '}'
+
+    return _font_face.sub(replace, css)
@@ -1,27 +1,52 @@
 import ast
+import asyncio
 import codecs
 import collections
+import concurrent.futures
+import contextlib
+import cProfile
 import datetime
 import enum
+import errno
+import functools
 import glob
+import gzip
+import hashlib
 import html
+import json
 import os
 import pathlib
 import re
 import shutil
 import string
-import zlib
+import sys
+import time
+import traceback
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 import markdown
+import markdown.extensions.footnotes
+import markdown.extensions.smarty
 import unidecode
-from css_html_js_minify import (
-    html_minify as _minify_html,
-    css_minify as _minify_css,
-)
+from css_html_js_minify import css_minify as _minify_css
 
-from . import katex, highlight, summarise
+from . import (
+    cache, critical, filewatch, fonts, images, katex, highlight, minify, server,
+    store, summarise, timing,
+)
 
-__all__ = ['update_all_articles', 'update_article', 'tidy_up', 'deploy_site']
+__all__ = [
+    'update_all_articles', 'update_article', 'tidy_up', 'deploy_site',
+    'prune_caches', 'watch', 'serve', 'profiling',
+]
 
 ARTICLES_DIRECTORY = pathlib.Path('articles')
 INFO_FILE = pathlib.Path('__article__.py')
@@ -32,14 +57,25 @@ TEMPLATE_DIRECTORY = pathlib.Path('template')
 TEMPLATE_HTML = pathlib.Path('index.html')
 TEMPLATE_ABOUT_MD = pathlib.Path('about/index.md')
 DEPLOY_DIRECTORY = pathlib.Path('deploy')
+DEPLOY_MANIFEST = pathlib.Path('.hbar-deploy')
 POSTS_DIRECTORY = pathlib.Path('posts')
 ABOUT_DIRECTORY = pathlib.Path('about')
 
 SITE = "https://binhbar.com"
 FEED_LOCATION = "atom.xml"
+FEED_ICON = "/images/favicon-128.png"
 
 IGNORED_ARTICLE_FILES = [str(INFO_FILE), str(CONTENT_FILE), str(METADATA_FILE)]
 IGNORED_TEMPLATE_FILES = [str(TEMPLATE_HTML), str(TEMPLATE_ABOUT_MD.name)]
+# Template directories whose files can be deployed under content-hashed names.
+FINGERPRINTED_DIRECTORIES = ['fonts', 'images', 'styles']
+# Other sites link to this as the preview of shared pages, so its URL must not
+# change.
+UNFINGERPRINTED_FILES = ['images/preview.png']
+ASSET_MANIFEST = pathlib.Path('assets.json')
+FONTS_DIRECTORY = pathlib.Path('fonts')
+# Fonts in the template which can be reduced to the characters the site uses.
+SUBSET_FONTS = 'Alegreya*.ttf'
 
 
 def _canonical_abs(path, site=False, file=False):
@@ -62,6 +98,9 @@ TAB_LIST = {
 }
 
 
+_footnotes = markdown.extensions.footnotes.FootnoteExtension()
+
+
 def _markdown_extensions(summary):
     out = [
         'smarty',
@@ -71,7 +110,7 @@ def _markdown_extensions(summary):
     if summary:
         out.append(summarise.Extension())
     else:
-        out.append("footnotes")
+        out.append(_footnotes)
     return out
 
 
@@ -80,62 +119,144 @@ _markdown = markdown.Markdown(output_format='html',
 _summarise = markdown.Markdown(output_format='html',
                                extensions=_markdown_extensions(summary=True))
 
-_url_tidyup_href = re.compile(r'href\s*=\s*(['"'"r'"])(.*?)\1')
-_url_tidyup_slash = re.compile(r'([^:])/+')
+
+def _convert_article(text):
+    """Convert the Markdown of an article to HTML, returning (full, summary)."""
+    _markdown.reset()
+    full, summary = summarise.convert(_markdown, text)
+    if _footnotes.footnotes:
+        # The summariser has no footnotes extension, so it reads footnote
+        # definitions as link references instead, and the summary has to be
+        # made from a separate parse.
+        _summarise.reset()
+        summary = _summarise.convert(text)
+    return full, summary
+
+
+
+class ArticleInfo:
+    """
+    The metadata of one article, as read from its store.  The rendered HTML is
+    not held in memory, but read from the store each time it is used.
+    """
+    __slots__ = (
+        'id', 'title', 'short_title', 'date', 'tags', 'output_path',
+        'input_path', 'image', 'image_alt', 'description', 'revision',
+        '_markdown', '_summary', '_truncated',
+    )
+
+    def __init__(self, article_id, record):
+        self.id = article_id
+        self.title = record['title']
+        self.short_title = record.get('short title')
+        self.date = datetime.datetime.fromisoformat(record['date'])
+        self.tags = tuple(record['tags'])
+        self.output_path = record['output path']
+        self.input_path = record['input path']
+        self.image = record.get('image')
+        self.image_alt = record.get('image_alt')
+        self.description = record.get('description')
+        self.revision = record.digest
+        self._markdown = record.loader('markdown')
+        self._summary = record.loader('summary')
+        self._truncated = record.get('truncated')
+
+    @property
+    def markdown(self):
+        return self._markdown()
+
+    @property
+    def summary(self):
+        return self._summary()
+
+    @property
+    def truncated(self):
+        """Whether the summary is shorter than the whole article."""
+        if self._truncated is None:
+            self._truncated = self.summary != self.markdown
+        return self._truncated
+
+
+def _read_articles(store_file):
+    """Read the metadata of every article in the global store."""
+    with open(store_file, "r") as global_store:
+        lines = [line.strip() for line in global_store.readlines()]
+        lines = [line for line in lines if line and line[0] != '#']
+        article_locations = ast.literal_eval("".join(lines))
+    return {
+        article_id: ArticleInfo(article_id, store.read(location / METADATA_FILE))
+        for article_id, location in article_locations.items()
+    }
 
 
 class SiteState:
-    def __init__(self, store_file, template_file):
+    def __init__(self, store_file, template_file, assets=None):
         self.environment = {
             'about': _canonical_abs(str(ABOUT_DIRECTORY)),
             'atom_feed': _canonical_abs(FEED_LOCATION, site=True, file=True),
         }
+        if assets is None:
+            assets = _template_assets()
+        for url, deployed_url in assets.items():
+            self.environment[_asset_key(url)] = deployed_url
         self._summaries = {}
         self._tags = collections.defaultdict(list)
+        self._newest_in_tag = collections.defaultdict(list)
         self._tag_indices = {}
 
-        articles = {}
-        with open(store_file, "r") as global_store:
-            lines = [line.strip() for line in global_store.readlines()]
-            lines = [line for line in lines if line and line[0] != '#']
-            article_locations = ast.literal_eval("".join(lines))
-        for article_id, location in article_locations.items():
-            with open(location / METADATA_FILE, "r") as file:
-                info = ast.literal_eval(file.read().strip())
-            info['date'] = datetime.datetime.fromisoformat(info['date'])
-            articles[article_id] = info
+        articles = _read_articles(store_file)
+        self._article_directories = {}
+        for article_id, info in articles.items():
             self.environment['article_' + article_id] =\
-                _canonical_abs(info['output path'])
+                _canonical_abs(info.output_path)
+            self._article_directories[_canonical_abs(info.output_path)] =\
+                pathlib.Path(info.input_path)
         # Guaranteed to remain sorted by age now, so will remain so in future
         # iterations, like making the tags.
         self._articles = {
             id: articles[id]
-            for id in sorted(articles, key=lambda id: articles[id]["date"])
+            for id in sorted(articles, key=lambda id: articles[id].date)
         }
 
-        for article_id, info in articles.items():
-            for tag in info["tags"]:
+        # Sorted once here, so the lists (and their pages) never need sorting.
+        # The newest first order keeps articles with equal dates in store
+        # order, as the oldest first order does.
+        self._newest = tuple(sorted(
+            self._articles, key=lambda id: articles[id].date, reverse=True))
+        for article_id, info in self._articles.items():
+            for tag in info.tags:
                 self._tags[tag].append(article_id)
-        for tag, articles in self._tags.items():
+        for article_id in self._newest:
+            for tag in articles[article_id].tags:
+                self._newest_in_tag[tag].append(article_id)
+        for tag in self._tags:
             safe_tag = _sanitise_tag(tag)
             self.environment['tag_' + safe_tag] = "/tags/" + safe_tag + "/"
-            self._tag_indices[tag] = {id: i for i, id in enumerate(articles)}
-
-        for article_id, info in self._articles.items():
-            self._summaries[article_id] = _html_summary(info, self.environment)
 
         with open(TEMPLATE_DIRECTORY / TEMPLATE_HTML, "r") as file:
             template = string.Template(file.read().strip())
         self._template = string.Template(template.safe_substitute({
             'tags': _html_tag_list(self._tags),
-            'recent_posts': _html_recent_posts(self._articles.values(), count=10),
+            'recent_posts': _html_recent_posts(
+                self._articles[id] for id in self._newest[:10]),
         }))
+        self.template_hash = _digest([
+            self._template.template, self.references(self._template.template),
+        ])
+
+    def newest(self):
+        """A sequence of every article, from newest to oldest."""
+        return self._newest
 
-    def articles_by_tag(self, tag: str):
-        """A sorted iterable from oldest to newest articles in a tag."""
-        return tuple(self._tags[tag])
+    def newest_in_tag(self, tag: str):
+        """A sequence of the articles in a tag, from newest to oldest."""
+        return self._newest_in_tag[tag]
 
     def seek_in_tag(self, tag: str, base_article: str, offset: int):
+        if tag not in self._tag_indices:
+            self._tag_indices[tag] = {
+                id: i for i, id in enumerate(self._tags[tag])
+            }
         base = self._tag_indices[tag][base_article]
         index = base + offset
         if 0 <= index < len(self._tags[tag]):
@@ -143,8 +264,36 @@ class SiteState:
         return None
 
     def summary(self, article):
+        if article not in self._summaries:
+            summary = _html_summary(self._articles[article], self.environment)
+            if _responsive_images:
+                summary = images.responsive(summary, self.article_file)
+            self._summaries[article] = summary
         return self._summaries[article]
 
+    def article_file(self, url):
+        """The source of a file deployed with an article, or None."""
+        directory, _, name = url.rpartition('/')
+        directory = self._article_directories.get(directory + '/')
+        if directory is None or not name or name in IGNORED_ARTICLE_FILES:
+            return None
+        path = directory / name
+        return path if path.is_file() else None
+
+    def revision(self, article_id):
+        """A digest of everything stored about an article."""
+        return self._articles[article_id].revision
+
+    def references(self, *texts):
+        """The environment entries that substituting into the texts can use."""
+        out = {}
+        for text in texts:
+            for match in string.Template.pattern.finditer(text):
+                key = match['named'] or match['braced']
+                if key in self.environment:
+                    out[key] = self.environment[key]
+        return out
+
     def apply_template(self, replacements):
         return self._template.substitute({**self.environment, **replacements})
 
@@ -158,12 +307,27 @@ class SiteState:
         return self._articles[article_id]
 
 
-def _url_tidyup(text):
-    return _url_tidyup_href.sub(lambda m: _url_tidyup_slash.sub(r'\1/', m[0]), text)
+def _digest(data):
+    if not isinstance(data, str):
+        data = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# Set from the '--minifier' option at the start of a deploy.
+_minify_html = minify.HTML_MINIFIERS['tokenise']
+# Set from the '--critical-css' option at the start of a deploy.
+_inline_css = False
+# Set from the '--responsive-images' option at the start of a deploy.
+_responsive_images = False
+# Everything that affects how generated pages are written, for the manifest.
+_page_options = {}
+# Roughly what the first round trip of a new connection can carry (ten TCP
+# segments), so inlined styles shouldn't delay the first render.
+CRITICAL_CSS_LIMIT = 14 * 1024
 
 
 def _postprocess_html(text):
-    return _minify_html(_url_tidyup(text))
+    return _minify_html(text)
 
 
 def cast_list(type_):
@@ -194,7 +358,8 @@ INFO_OPTIONAL = {
     "description": str,
 }
 INFO_COMPUTED = {
-    "checksum", "markdown", "summary", "output path", "input path"
+    "checksum", "files", "markdown", "summary", "truncated", "output path",
+    "input path",
 }
 INFO_ALL = set(INFO_NECESSARY) | set(INFO_OPTIONAL) | INFO_COMPUTED
 
@@ -229,23 +394,50 @@ def _parse_info_file(path):
     return _validate_info_file(info)
 
 
-def _checksum_directory(directory, exclude=None):
+_HASH_CHUNK_SIZE = 1 << 20
+# Files modified this recently may be modified again within the resolution of
+# their mtime, so their stat can't yet be trusted to detect a change.
+_RACY_WINDOW_NS = 2_000_000_000
+
+
+def _hash_file(path):
+    hash_ = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        while chunk := file.read(_HASH_CHUNK_SIZE):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def _checksum_directory(directory, exclude=None, previous=None):
+    """
+    Hash the contents of every file below ``directory`` whose name is not in
+    ``exclude``, returning ``(checksum, files)``.  ``files`` maps relative paths
+    to ``[size, mtime, inode, digest]``, and can be passed back in as
+    ``previous`` so that files whose stat is unchanged are not read again.
+    """
+    directory = pathlib.Path(directory)
     exclude = set(exclude or [])
-    previous_directory = os.getcwd()
-    all_paths = []
-    try:
-        os.chdir(directory)
-        for root, _, files in os.walk('.'):
-            root_path = pathlib.Path(root)
-            all_paths.extend([root_path/file for file in files
-                              if file not in exclude])
-        hash_ = 0
-        for path in all_paths:
-            with open(path, "rb") as f:
-                hash_ = zlib.crc32(f.read(), hash_)
-    finally:
-        os.chdir(previous_directory)
-    return hash_
+    previous = previous or {}
+    paths = []
+    for root, _, files in os.walk(directory):
+        root_path = pathlib.Path(root).relative_to(directory)
+        paths.extend((root_path / file).as_posix() for file in files
+                     if file not in exclude)
+    now = time.time_ns()
+    out, hash_ = {}, hashlib.blake2b(digest_size=16)
+    for path in sorted(paths):
+        stat = (directory / path).stat()
+        mtime = stat.st_mtime_ns
+        old = previous.get(path)
+        if old is not None and old[:3] == [stat.st_size, mtime, stat.st_ino]:
+            digest = old[3]
+        else:
+            digest = _hash_file(directory / path)
+        if now - mtime < _RACY_WINDOW_NS:
+            mtime = None
+        out[path] = [stat.st_size, mtime, stat.st_ino, digest]
+        hash_.update(f"{path}\0{digest}\n".encode('utf-8'))
+    return hash_.hexdigest(), out
 
 
 def _url_sanitise_title(info):
@@ -260,47 +452,68 @@ def update_article(path, *, vars):
     path = pathlib.Path(path)
     if not (path.exists() and path.is_dir()):
         raise ValueError("Could not access directory " + path.name + ".")
-    store = path / METADATA_FILE
-    checksum = _checksum_directory(path, exclude=[METADATA_FILE.name])
+    store_path = path / METADATA_FILE
     store_info = None
-    if store.exists():
+    if store_path.exists():
         try:
-            with open(store, "r") as f:
-                store_info = ast.literal_eval(f.read())
-            if store_info['checksum'] == checksum and not vars['force']:
-                return 0
-        except (SyntaxError, OSError):
+            store_info = store.read(store_path)
+        except (ValueError, OSError):
             pass
+    checksum, files = _checksum_directory(
+        path, exclude=[METADATA_FILE.name],
+        previous=store_info and store_info.get('files'),
+    )
+    if (store_info and store_info.get('checksum') == checksum
+            and not vars['force']):
+        if store_info.get('files') != files:
+            # Only the stat of some files changed, so remember the new stat to
+            # keep the next check fast.
+            store_info['files'] = files
+            store.write(store_path, store_info)
+        return 0
     info = _parse_info_file(path / INFO_FILE)
     if store_info:
         store_info.update(info)
         info = store_info
     info["checksum"] = checksum
+    info["files"] = files
     with codecs.open(path / CONTENT_FILE, mode="r", encoding="utf-8") as file:
         article = file.read()
-    _markdown.reset()
-    _summarise.reset()
-    info["markdown"] = _markdown.convert(article)
-    info["summary"] = _summarise.convert(article)
+    info["markdown"], info["summary"] = _convert_article(article)
+    info["truncated"] = info["summary"] != info["markdown"]
     info["input path"] = str(path)
     date = datetime.datetime.fromisoformat(info["date"])
     if "output path" not in info:
         info["output path"] = str(POSTS_DIRECTORY
                                   / date.strftime("%Y/%m")
                                   / _url_sanitise_title(info))
-    with open(store, "w") as f:
-        print(str(info), file=f)
+    store.write(store_path, info)
     return 0
 
 
+def _try_update_article(path, vars):
+    try:
+        return update_article(path, vars=vars), None
+    except ValueError as error:
+        return 1, str(error)
+
+
 def update_all_articles(*, vars):
     base = ARTICLES_DIRECTORY
+    paths = [pathlib.Path(article).parent for article in
+             sorted(glob.glob(str(base/'**'/INFO_FILE), recursive=True))]
+    jobs = min(vars.get('jobs') or os.cpu_count() or 1, len(paths))
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_try_update_article, paths,
+                                    [vars] * len(paths)))
+    else:
+        results = [_try_update_article(path, vars) for path in paths]
     exit_code = 0
-    for article in glob.glob(str(base/'**'/INFO_FILE), recursive=True):
-        try:
-            update_article(pathlib.Path(article).parent, vars=vars)
-        except ValueError:
-            exit_code += 1
+    for path, (code, error) in zip(paths, results):
+        if error is not None:
+            print(f"{path}: {error}", file=sys.stderr)
+        exit_code += code
     return exit_code
 
 
@@ -308,14 +521,88 @@ def tidy_up(*, vars):
     pass
 
 
+def prune_caches(*, vars):
+    for cache_ in cache.caches():
+        removed = cache_.prune()
+        print(f"Pruned {removed} entries from the {cache_.name} cache.")
+    return 0
+
+
+_css_url = re.compile(r'''url\(\s*(['"]?)(/[^'")?#\s]+)''')
+
+
+def _rewrite_css_urls(text, assets):
+    return _css_url.sub(lambda m: f"url({m[1]}{assets.get(m[2], m[2])}", text)
+
+
+def _asset_key(url):
+    """The environment key of a template asset, like `asset_styles_text_css`."""
+    return 'asset_' + re.sub(r'\W', '_', url.strip('/'))
+
+
+def _fingerprinted(url, digest):
+    path = pathlib.PurePosixPath(url)
+    return str(path.with_name(f"{path.stem}.{digest[:10]}{path.suffix}"))
+
+
+def _replaced_by_subset(path, font_subsets):
+    return (path.parent == TEMPLATE_DIRECTORY / FONTS_DIRECTORY
+            and path.stem in font_subsets)
+
+
+def _rewrite_css(text, assets, font_subsets):
+    return _rewrite_css_urls(fonts.rewrite_font_faces(text, font_subsets), assets)
+
+
+def _template_assets(fingerprint=False, font_subsets=None):
+    """
+    Map the URL of every file in `FINGERPRINTED_DIRECTORIES` to the URL it is
+    deployed at.  If ``fingerprint`` is true, this includes a hash of the
+    deployed contents, so the files can be served as immutable.  Fonts which
+    are replaced by the subsets in ``font_subsets`` are not deployed at all.
+    """
+    assets = {}
+    stylesheets = []
+    for directory in FINGERPRINTED_DIRECTORIES:
+        for path in sorted((TEMPLATE_DIRECTORY / directory).rglob('*')):
+            if not path.is_file() or _replaced_by_subset(path, font_subsets or {}):
+                continue
+            relative = path.relative_to(TEMPLATE_DIRECTORY).as_posix()
+            url = '/' + relative
+            if not fingerprint or relative in UNFINGERPRINTED_FILES:
+                assets[url] = url
+            elif path.suffix.lower() == '.css':
+                stylesheets.append((url, path))
+            else:
+                assets[url] = _fingerprinted(url, _hash_file(path))
+    # Stylesheets refer to fonts and images, so their contents (and hashes)
+    # depend on the names of everything else.
+    for url, path in stylesheets:
+        text = _rewrite_css(path.read_text(), assets, font_subsets)
+        assets[url] = _fingerprinted(url, _digest(text))
+    return assets
+
+
+def _unlink(path):
+    # Deployed files may be hard links to their sources, so they must be
+    # replaced rather than written through.
+    pathlib.Path(path).unlink(missing_ok=True)
+
+
 def _copy_minified_html(src, dest):
+    _unlink(dest)
     with open(src, "r") as input, open(dest, "w") as output:
         output.write(_postprocess_html(input.read()))
 
 
-def _copy_minified_css(src, dest):
-    with open(src, "r") as input, open(dest, "w") as output:
-        output.write(_minify_css(input.read()))
+def _copy_minified_css(src, dest, assets=None, font_subsets=None):
+    _unlink(dest)
+    with open(src, "r") as input:
+        text = input.read()
+    if assets or font_subsets:
+        text = _rewrite_css(text, assets or {}, font_subsets)
+    with open(dest, "w") as output:
+        output.write(_minify_css(text))
 
 
 _FILE_COPY_FILTERS = {
@@ -323,10 +610,60 @@ _FILE_COPY_FILTERS = {
     '.css': _copy_minified_css,
 }
 
+# The FICLONE ioctl from <linux/fs.h>, which shares the data blocks of one file
+# with another on filesystems that support it (btrfs, XFS, ...).
+_FICLONE = 0x40049409
+# Failures that mean "this filesystem or pair of paths can't do that".
+_LINK_UNSUPPORTED = {
+    errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP,
+    errno.EMLINK, errno.EBADF,
+}
+
+
+def _copy(src, dest):
+    _unlink(dest)
+    return shutil.copy2(src, dest)
+
+
+def _reflink(src, dest):
+    if fcntl is None:
+        return _copy(src, dest)
+    _unlink(dest)
+    try:
+        with open(src, "rb") as input, open(dest, "wb") as output:
+            fcntl.ioctl(output.fileno(), _FICLONE, input.fileno())
+    except OSError as error:
+        if error.errno not in _LINK_UNSUPPORTED:
+            raise
+        return _copy(src, dest)
+    shutil.copystat(src, dest)
+    return dest
+
+
+def _hardlink(src, dest):
+    _unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError as error:
+        if error.errno not in _LINK_UNSUPPORTED:
+            raise
+        return _copy(src, dest)
+    return dest
+
+
+ASSET_COPY_FUNCTIONS = {
+    'copy': _copy,
+    'reflink': _reflink,
+    'hardlink': _hardlink,
+}
+# How files that need no filtering get into the deployment.  Set from the
+# '--link' option at the start of a deploy.
+_copy_asset = _copy
+
 
 def _copy_with_filter(src, dest):
     extension = pathlib.Path(src).suffix.lower()
-    return _FILE_COPY_FILTERS.get(extension, shutil.copy2)(src, dest)
+    return _FILE_COPY_FILTERS.get(extension, _copy_asset)(src, dest)
 
 
 def _sanitise_tag(tag):
@@ -368,13 +705,13 @@ def _html_tabs(current_tab):
 
 
 def _html_meta(info, article, title=None, path=None, description=None):
-    path = _canonical_abs(path if path is not None else info["output path"],
+    path = _canonical_abs(path if path is not None else info.output_path,
                           site=True)
-    title = title or info.get("short title", info["title"])
-    description = description or info.get('description', None)
-    if 'image' in info:
-        image = path + info['image']
-        alt = info.get('image_alt', description)
+    title = title or info.short_title or info.title
+    description = description or (info and info.description)
+    if info is not None and info.image is not None:
+        image = path + info.image
+        alt = info.image_alt if info.image_alt is not None else description
     else:
         image = '/images/preview.png'
         alt = "Title card for /bin/&#x127; and photograph of Jake Lishman"
@@ -426,27 +763,27 @@ def _html_byline(date, tags):
 def _html_summary(info, environment):
     title = ''.join([
         '<h2 class="article-title">',
-        '<a href="', _canonical_abs(info['output path']), '">',
-        info['title'],
+        '<a href="', _canonical_abs(info.output_path), '">',
+        info.title,
         '</a></h2>',
     ])
-    if info['summary'] == info['markdown']:
+    if not info.truncated:
         read_more = ''
     else:
         read_more = ''.join([
             '<footer><p class="read-more">',
-            '<a href="', _canonical_abs(info['output path']), '">',
+            '<a href="', _canonical_abs(info.output_path), '">',
             'Read more&#8230;</a></p></footer>',
         ])
-    text = string.Template(info['summary']).safe_substitute({
-        'article': _canonical_abs(info['output path']).rstrip('/'),
+    text = string.Template(info.summary).safe_substitute({
+        'article': _canonical_abs(info.output_path).rstrip('/'),
         **environment,
     })
     return ''.join([
         '<article class="summary" itemscope>',
         '<header>',
         title,
-        _html_byline(info['date'], info['tags']),
+        _html_byline(info.date, info.tags),
         '</header>',
         '<div class="article-summary-text">', text, '</div>',
         read_more,
@@ -466,34 +803,41 @@ def _html_tag_list(tags):
     )
 
 
-def _html_recent_posts(article_infos, count):
+def _html_recent_posts(article_infos):
     def item(info):
         return ''.join([
             '<li>',
-            '<a href="', _canonical_abs(info['output path']), '">',
-            info['title'],
+            '<a href="', _canonical_abs(info.output_path), '">',
+            info.title,
             '</a>', '</li>',
         ])
-    recent = sorted(article_infos, key=lambda x: x['date'], reverse=True)
-    return ''.join(item(info) for info in recent[:count])
+    return ''.join(item(info) for info in article_infos)
+
+
+def _article_text(article_id, state):
+    """The HTML of an article's body, with the site's URLs substituted in."""
+    return string.Template(state.article_info(article_id).markdown).safe_substitute({
+        'article': state.environment['article_' + article_id],
+        **state.environment,
+    })
 
 
 def _html_article(article_id, state):
     info = state.article_info(article_id)
     header = ''.join([
         '<header id="main-header">',
-        '<h1>', '<a href="', _canonical_abs(info['output path']), '">',
-        info['title'],
+        '<h1>', '<a href="', _canonical_abs(info.output_path), '">',
+        info.title,
         '</a>', '</h1>',
-        _html_byline(info['date'], info['tags']),
+        _html_byline(info.date, info.tags),
         '</header>',
     ])
 
     def link(article_id):
         info = state.article_info(article_id)
         return ''.join([
-            f'<a href="{_canonical_abs(info["output path"])}">',
-            info.get("short title", info["title"]),
+            f'<a href="{_canonical_abs(info.output_path)}">',
+            info.short_title or info.title,
             '</a>',
         ])
 
@@ -520,7 +864,7 @@ def _html_article(article_id, state):
             '</section>',
         ])
 
-    related = ''.join(tag_item(tag) for tag in info["tags"])
+    related = ''.join(tag_item(tag) for tag in info.tags)
     if related:
         footer = ''.join([
             '<footer id="main-footer">',
@@ -530,10 +874,9 @@ def _html_article(article_id, state):
         ])
     else:
         footer = ''
-    text = string.Template(info['markdown']).safe_substitute({
-        'article': state.environment['article_' + article_id],
-        **state.environment,
-    })
+    text = _article_text(article_id, state)
+    if _responsive_images:
+        text = images.responsive(text, state.article_file)
     return ''.join([
         '<article itemscope>',
         header,
@@ -568,87 +911,167 @@ def _html_list_footer(path, page, n_pages):
     return ''.join(['<span id="list-page-navigation">', links, '</span>'])
 
 
-def _deploy_article(article_id, state, description=None):
+def _deployed(path):
+    """The path of a file in the deployment, relative to its root."""
+    return pathlib.Path(path).relative_to(DEPLOY_DIRECTORY).as_posix()
+
+
+@functools.lru_cache(maxsize=None)
+def _read_stylesheet(path, mtime):
+    with open(path, "r") as file:
+        return file.read()
+
+
+def _deployed_stylesheet(url):
+    """The text of a stylesheet in the deployment, or None if it isn't one."""
+    if not url.startswith('/') or url.startswith('//'):
+        return None
+    path = DEPLOY_DIRECTORY / url.lstrip('/')
+    if path.suffix.lower() != '.css':
+        return None
+    try:
+        return _read_stylesheet(path, path.stat().st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+def _page(directory, text):
+    """
+    Post-process a page, returning its path in the deployment (as
+    ``directory/index.html``) and its final text.
+    """
+    if _inline_css:
+        text = critical.inline(text, _deployed_stylesheet, CRITICAL_CSS_LIMIT)
+    path = pathlib.PurePosixPath(directory, "index.html")
+    return path.as_posix(), _postprocess_html(text)
+
+
+def _write_files(files):
+    """
+    Write the ``(path, text)`` pairs of rendered files into the deployment,
+    returning the paths written.
+    """
+    outputs = []
+    for path, text in files:
+        destination = DEPLOY_DIRECTORY / path
+        os.makedirs(destination.parent, exist_ok=True)
+        _unlink(destination)
+        with open(destination, "w") as file:
+            file.write(text)
+        outputs.append(path)
+    return outputs
+
+
+def _render_article(article_id, state, description=None):
     info = state.article_info(article_id)
-    output_path = pathlib.Path(info["output path"])
-    shutil.copytree(info["input path"], DEPLOY_DIRECTORY / output_path,
-                    ignore=lambda *_: IGNORED_ARTICLE_FILES)
     output = state.apply_template({
-        'head_title': info["title"],
+        'head_title': info.title,
         'tabs': _html_tabs(Tabs.Blog),
         'meta': _html_meta(info, article=True, description=description),
         'content': _html_article(article_id, state),
     })
-    with open(DEPLOY_DIRECTORY / output_path / "index.html", "w") as file:
-        file.write(_postprocess_html(output))
+    return [_page(info.output_path, output)]
+
+
+def _deploy_article(article_id, state, description=None):
+    info = state.article_info(article_id)
+    output_path = pathlib.Path(info.output_path)
+    outputs = []
+
+    # Only the images that the article shows with a `srcset` need smaller
+    # copies, and not (say) its preview image.
+    resized = (images.resized(_article_text(article_id, state), state.article_file)
+               if _responsive_images else set())
+
+    def copy(src, dest):
+        outputs.append(_deployed(dest))
+        if pathlib.Path(src) in resized:
+            for name, data in images.derivatives(pathlib.Path(src)):
+                derivative = pathlib.Path(dest).with_name(name)
+                _unlink(derivative)
+                with open(derivative, "wb") as file:
+                    file.write(data)
+                outputs.append(_deployed(derivative))
+        return _copy_asset(src, dest)
+
+    shutil.copytree(info.input_path, DEPLOY_DIRECTORY / output_path,
+                    ignore=lambda *_: IGNORED_ARTICLE_FILES,
+                    copy_function=copy, dirs_exist_ok=True)
+    outputs.extend(_write_files(_render_article(article_id, state, description)))
+    return outputs
+
+
+ARTICLES_PER_PAGE = 10
+
 
+def _page_count(article_ids):
+    return max(1, -(-len(article_ids) // ARTICLES_PER_PAGE))
 
-def _chunk(sequence, n):
-    sequence = tuple(sequence)
-    return [sequence[ptr : ptr + n] for ptr in range(0, len(sequence), n)]
 
+def _list_pages(article_ids):
+    """The page numbers of a list of articles, counting from 1."""
+    return range(1, _page_count(article_ids) + 1)
 
-def _deploy_list(article_ids, state, title, path,
+
+def _list_page(article_ids, page):
+    """The articles on ``page`` of the newest-first sequence ``article_ids``."""
+    start = (page - 1) * ARTICLES_PER_PAGE
+    return article_ids[start:start + ARTICLES_PER_PAGE]
+
+
+def _render_list(article_ids, page, state, title, path,
                  head_title=None, meta_title=None, description=None):
+    """
+    Render ``page`` (counting from 1) of the summaries of ``article_ids``,
+    which must already be sorted from newest to oldest.
+    """
     path = path.strip("/")
     head_title = head_title or title
-    chronological = sorted(
-        article_ids, key=lambda x: state.article_info(x)['date'], reverse=True
-    )
-    chunks = list(_chunk(chronological, 10))
-    n_chunks = len(chunks)
-    for n, articles in enumerate(chunks):
-        output_directory = pathlib.Path(path)
-        if n > 0:
-            output_directory = output_directory / "page" / str(n+1)
-        header = ''.join([
-            '<header id="main-header">',
-            '<h1>', '<a href="', _canonical_abs(output_directory), '">',
-            title,
-            '</a></h1></header>',
-        ])
-        content = ''.join(state.summary(article) for article in articles)
-        footer = _html_list_footer(path, n+1, n_chunks)
-        content = ''.join([header, content, footer])
-        output = state.apply_template({
-            'head_title': head_title,
-            'tabs': _html_tabs(Tabs.Blog),
-            'meta': _html_meta(
-                {}, article=False, title=meta_title or title,
-                path=path, description=description,
-            ),
-            'content': content,
-        })
-        deploy_directory = DEPLOY_DIRECTORY / output_directory
-        os.makedirs(deploy_directory, exist_ok=True)
-        with open(deploy_directory / "index.html", "w") as file:
-            file.write(_postprocess_html(output))
-
-
-def _deploy_main_page(state):
+    output_directory = pathlib.Path(path)
+    if page > 1:
+        output_directory = output_directory / "page" / str(page)
+    header = ''.join([
+        '<header id="main-header">',
+        '<h1>', '<a href="', _canonical_abs(output_directory), '">',
+        title,
+        '</a></h1></header>',
+    ])
+    content = ''.join(
+        state.summary(article) for article in _list_page(article_ids, page))
+    footer = _html_list_footer(path, page, _page_count(article_ids))
+    content = ''.join([header, content, footer])
+    output = state.apply_template({
+        'head_title': head_title,
+        'tabs': _html_tabs(Tabs.Blog),
+        'meta': _html_meta(
+            None, article=False, title=meta_title or title,
+            path=path, description=description,
+        ),
+        'content': content,
+    })
+    return [_page(output_directory, output)]
+
+
+def _render_main_page(page, state):
     description = " ".join([
         "Research software developer at IBM Quantum.",
         "Posts about quantum software development and trapped-ion quantum computing.",
     ])
-    _deploy_list(state.article_ids(), state, "Recent posts", "/",
-                 head_title="Jake Lishman", meta_title="Blog of Jake Lishman",
-                 description=description)
-
-
-def _deploy_articles(state):
-    for article_id in state.article_ids():
-        _deploy_article(article_id, state)
+    return _render_list(state.newest(), page, state, "Recent posts", "/",
+                        head_title="Jake Lishman",
+                        meta_title="Blog of Jake Lishman",
+                        description=description)
 
 
-def _deploy_tags(state):
-    for tag in state.tags():
-        _deploy_list(state.articles_by_tag(tag),
-                     state,
-                     f"Posts tagged ‘{tag}’",
-                     state.environment['tag_' + _sanitise_tag(tag)])
+def _render_tag(tag, page, state):
+    return _render_list(state.newest_in_tag(tag),
+                        page,
+                        state,
+                        f"Posts tagged ‘{tag}’",
+                        state.environment['tag_' + _sanitise_tag(tag)])
 
 
-def _deploy_about(state):
+def _render_about(state):
     with open(TEMPLATE_DIRECTORY / TEMPLATE_ABOUT_MD, "r") as file:
         about = file.read().strip()
     _markdown.reset()
@@ -657,41 +1080,41 @@ def _deploy_about(state):
     output = state.apply_template({
         'head_title': 'Jake Lishman',
         'tabs': _html_tabs(Tabs.About),
-        'meta': _html_meta({}, article=False, title="Jake Lishman", path=path),
+        'meta': _html_meta(None, article=False, title="Jake Lishman", path=path),
         'content': string.Template(content).safe_substitute(state.environment),
     })
-    output_directory = DEPLOY_DIRECTORY / ABOUT_DIRECTORY
-    os.makedirs(output_directory, exist_ok=True)
-    with open(output_directory / "index.html", "w") as file:
-        file.write(_postprocess_html(output))
+    return [_page(ABOUT_DIRECTORY, output)]
 
 
 def _make_feed_entry(state, article_id):
     info = state.article_info(article_id)
-    path = _canonical_abs(info["output path"], site=True)
-    text = string.Template(info['summary']).safe_substitute({
-        'article': _canonical_abs(info['output path']).rstrip('/'),
+    path = _canonical_abs(info.output_path, site=True)
+    text = string.Template(info.summary).safe_substitute({
+        'article': _canonical_abs(info.output_path).rstrip('/'),
         **state.environment,
     })
     return "\n".join([
         "<entry>",
-        f'<title>{info["title"]}</title>',
+        f'<title>{info.title}</title>',
         f'<link rel="alternate" href="{path}"/>',
         f'<id>{path}</id>',
-        f'<updated>{info["date"].isoformat()}</updated>',
+        f'<updated>{info.date.isoformat()}</updated>',
         '<summary type="html">',
         html.escape(text),
         '</summary>',
-        ''.join(f'<category term="{tag}"/>' for tag in info["tags"]),
+        ''.join(f'<category term="{tag}"/>' for tag in info.tags),
         '</entry>',
     ])
 
-def _deploy_feed(state):
+def _feed_icon(state):
+    """The URL the feed's icon is deployed at, which may be fingerprinted."""
+    return state.environment[_asset_key(FEED_ICON)]
+
+
+def _render_feed(state):
     site_root = _canonical_abs("/", site=True)
     now = datetime.datetime.now(tz=datetime.timezone.utc)
-    recent = sorted(
-        state.article_ids(), key=lambda x: state.article_info(x)['date'], reverse=True
-    )[:25]
+    recent = _recent_articles(state, 25)
     header = "\n".join([
         '<?xml version="1.0" encoding="utf-8"?>'
         '<feed xmlns="http://www.w3.org/2005/Atom">'
@@ -704,27 +1127,686 @@ def _deploy_feed(state):
         f'<author><name>Jake Lishman</name><uri>{site_root}</uri></author>'
         '<category term="programming"/>'
         '<category term="quantum computing"/>'
-        f'<icon>{_canonical_abs("images/favicon-128.png", file=True)}</icon>'
+        f'<icon>{_feed_icon(state)}</icon>'
     ])
-    with open(DEPLOY_DIRECTORY / FEED_LOCATION, "w") as file:
-        file.write(header)
-        for article_id in recent:
-            file.write(_make_feed_entry(state, article_id))
-        file.write("</feed>\n")
+    text = "".join([
+        header,
+        *(_make_feed_entry(state, article_id) for article_id in recent),
+        "</feed>\n",
+    ])
+    return [(FEED_LOCATION, text)]
+
+
+def _deploy_main_page(page, state):
+    return _write_files(_render_main_page(page, state))
+
+
+def _deploy_tag(tag, page, state):
+    return _write_files(_render_tag(tag, page, state))
+
+
+def _deploy_about(state):
+    return _write_files(_render_about(state))
+
+
+def _deploy_feed(state):
+    return _write_files(_render_feed(state))
+
+
+def _recent_articles(state, count):
+    return state.newest()[:count]
+
+
+def _deploy_tasks(state):
+    """
+    Every page-writing job of a deploy as ``(function, *args)``, each called as
+    ``function(*args, state)`` and returning the paths it wrote.  Once the
+    template has been copied, these are all independent of each other.  Each
+    page of a list is a job of its own, so that editing an article only
+    rewrites the list pages it is on.
+    """
+    return [
+        *((_deploy_main_page, page) for page in _list_pages(state.newest())),
+        *((_deploy_article, article_id) for article_id in state.article_ids()),
+        *((_deploy_tag, tag, page)
+          for tag in state.tags() for page in _list_pages(state.newest_in_tag(tag))),
+        (_deploy_about,),
+        (_deploy_feed,),
+    ]
+
+
+def _list_inputs(article_ids, state):
+    return {
+        'articles': [[id, state.revision(id)] for id in article_ids],
+        'environment': state.references(
+            *(state.article_info(id).summary for id in article_ids)
+        ),
+    }
+
+
+def _list_page_inputs(article_ids, page, state):
+    return {
+        # Which pages the navigation links to.
+        'pages': _page_count(article_ids),
+        **_list_inputs(_list_page(article_ids, page), state),
+    }
 
-def deploy_site(*, vars):
-    state = SiteState(STORE_FILE, TEMPLATE_DIRECTORY / TEMPLATE_HTML)
 
+def _article_inputs(article_id, state):
+    info = state.article_info(article_id)
+    # The tag navigation shows the titles of the neighbouring articles.
+    related = {article_id}.union(*(
+        (state.seek_in_tag(tag, article_id, -1),
+         state.seek_in_tag(tag, article_id, 1))
+        for tag in info.tags
+    )) - {None}
+    return {
+        'articles': {id: state.revision(id) for id in sorted(related)},
+        'environment': state.references(info.markdown),
+        # The article's own files are copied or linked in as '--link' says.
+        'link': _copy_asset.__name__,
+    }
+
+
+def _about_inputs(state):
+    with open(TEMPLATE_DIRECTORY / TEMPLATE_ABOUT_MD, "r") as file:
+        about = file.read().strip()
+    return {'about': _digest(about), 'environment': state.references(about)}
+
+
+_DEPLOY_INPUTS = {
+    _deploy_main_page: lambda page, state: _list_page_inputs(
+        state.newest(), page, state),
+    _deploy_article: _article_inputs,
+    _deploy_tag: lambda tag, page, state: _list_page_inputs(
+        state.newest_in_tag(tag), page, state),
+    _deploy_about: _about_inputs,
+    # The feed's own timestamp is deliberately not an input, so an unchanged
+    # feed keeps its old <updated> time.
+    _deploy_feed: lambda state: {
+        'icon': _feed_icon(state),
+        **_list_inputs(_recent_articles(state, 25), state),
+    },
+}
+# Modules (besides this one) whose code shapes deployed files, so that changing
+# any of them redeploys everything.  The about page is rendered at deploy time,
+# so the Markdown extensions count too.
+_OUTPUT_MODULES = [critical, fonts, highlight, images, katex, minify]
+_CODE_HASH = _digest("".join(
+    pathlib.Path(path).read_text()
+    for path in [__file__, *(module.__file__ for module in _OUTPUT_MODULES)]
+))
+
+
+def _task_key(task):
+    function, *args = task
+    return ':'.join([function.__name__.lstrip('_'), *map(str, args)])
+
+
+def _task_manifest(task, state):
+    """
+    The manifest entry of a task, without its outputs: the inputs that the
+    pages it writes depend on, and a signature of them all.
+    """
+    function, *args = task
+    inputs = {
+        'code': _CODE_HASH,
+        'options': _page_options,
+        'template': state.template_hash,
+        **_DEPLOY_INPUTS[function](*args, state),
+    }
+    return _task_key(task), {'signature': _digest(inputs), 'inputs': inputs}
+
+
+def _read_deploy_manifest():
     try:
-        shutil.rmtree(DEPLOY_DIRECTORY)
-    except FileNotFoundError:
-        pass
-    shutil.copytree(TEMPLATE_DIRECTORY, DEPLOY_DIRECTORY,
-                    ignore=lambda *_: IGNORED_TEMPLATE_FILES,
-                    copy_function=_copy_with_filter)
-    _deploy_main_page(state)
-    _deploy_articles(state)
-    _deploy_tags(state)
-    _deploy_about(state)
-    _deploy_feed(state)
+        with open(DEPLOY_MANIFEST, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != 1:
+        return {}
+    return manifest['entries']
+
+
+def _write_deploy_manifest(entries):
+    with open(DEPLOY_MANIFEST, "w") as file:
+        json.dump({'version': 1, 'entries': entries}, file, indent=1,
+                  sort_keys=True)
+
+
+def _up_to_date(entry, previous):
+    return (previous is not None
+            and previous['signature'] == entry['signature']
+            and all((DEPLOY_DIRECTORY / path).exists()
+                    for path in previous['outputs']))
+
+
+def _deploy_template(previous, assets, font_subsets):
+    """
+    Copy the static template into the deployment, skipping files unchanged
+    since the ``previous`` manifest entries.  Files in ``assets`` are deployed
+    under the names it maps them to, and fonts in ``font_subsets`` are left
+    out.  Returns the new entries.
+    """
+    entries = {}
+    for root, directories, files in os.walk(TEMPLATE_DIRECTORY):
+        directories.sort()
+        for name in sorted(files):
+            if name in IGNORED_TEMPLATE_FILES:
+                continue
+            source = pathlib.Path(root) / name
+            if _replaced_by_subset(source, font_subsets):
+                continue
+            url = '/' + source.relative_to(TEMPLATE_DIRECTORY).as_posix()
+            destination = DEPLOY_DIRECTORY / assets.get(url, url).lstrip('/')
+            stat = source.stat()
+            inputs = {'code': _CODE_HASH, 'minifier': _minify_html.__name__,
+                      'source': source.as_posix(),
+                      'output': _deployed(destination),
+                      'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            if source.suffix.lower() == '.css' and font_subsets:
+                inputs['fonts'] = font_subsets
+            if source.suffix.lower() not in _FILE_COPY_FILTERS:
+                inputs['link'] = _copy_asset.__name__
+            key = 'template:' + url.lstrip('/')
+            entry = {'signature': _digest(inputs), 'inputs': inputs,
+                     'outputs': [_deployed(destination)]}
+            if not _up_to_date(entry, previous.get(key)):
+                os.makedirs(destination.parent, exist_ok=True)
+                if source.suffix.lower() == '.css':
+                    _copy_minified_css(source, destination, assets, font_subsets)
+                else:
+                    _copy_with_filter(source, destination)
+            entries[key] = entry
+    return entries
+
+
+def _site_texts():
+    """Everything that the generated pages show, as HTML or Markdown."""
+    for info in _read_articles(STORE_FILE).values():
+        yield info.markdown
+        yield from filter(None, (info.title, info.short_title,
+                                 info.description, info.image_alt))
+        yield from info.tags
+    for path in (TEMPLATE_HTML, TEMPLATE_ABOUT_MD):
+        with open(TEMPLATE_DIRECTORY / path, "r") as file:
+            yield file.read()
+    # Quotes, dashes and ellipses that 'smarty' puts in while rendering.
+    yield ''.join(markdown.extensions.smarty.substitutions.values())
+
+
+def _subset_fonts(previous):
+    """
+    Write woff2 subsets of the `SUBSET_FONTS` holding only the characters that
+    the site uses, skipping any unchanged since the ``previous`` manifest
+    entries.  Returns a map from the name of each font to the URL of its
+    subset, and the new entries.
+    """
+    characters = fonts.characters(_site_texts())
+    subsets, entries = {}, {}
+    for source in sorted((TEMPLATE_DIRECTORY / FONTS_DIRECTORY).glob(SUBSET_FONTS)):
+        data, digest = fonts.subset(source.read_bytes(), characters)
+        destination = (DEPLOY_DIRECTORY / FONTS_DIRECTORY
+                       / f"{source.stem}.{digest[:10]}.woff2")
+        inputs = {'source': source.as_posix(), 'characters': _digest(characters)}
+        entry = {'signature': digest, 'inputs': inputs,
+                 'outputs': [_deployed(destination)]}
+        key = 'font:' + source.stem
+        if not _up_to_date(entry, previous.get(key)):
+            os.makedirs(destination.parent, exist_ok=True)
+            _unlink(destination)
+            with open(destination, "wb") as file:
+                file.write(data)
+        subsets[source.stem] = '/' + _deployed(destination)
+        entries[key] = entry
+    return subsets, entries
+
+
+def _write_asset_manifest(assets, previous):
+    """
+    Write the map from the original to the fingerprinted URLs of the template
+    assets into the deployment, for the web server's use, unless it is
+    unchanged since the ``previous`` manifest entry.  Returns the new entry.
+    """
+    path = DEPLOY_DIRECTORY / ASSET_MANIFEST
+    text = json.dumps(assets, indent=1, sort_keys=True)
+    entry = {'signature': _digest(text), 'inputs': {}, 'outputs': [_deployed(path)]}
+    if not _up_to_date(entry, previous):
+        _unlink(path)
+        with open(path, "w") as file:
+            file.write(text)
+    return entry
+
+
+def _remove_stale_outputs(previous, entries):
+    current = {path for entry in entries.values() for path in entry['outputs']}
+    stale = {path for entry in previous.values() for path in entry['outputs']}
+    for path in sorted(stale - current):
+        path = DEPLOY_DIRECTORY / path
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        for directory in path.parents:
+            if directory == DEPLOY_DIRECTORY or any(directory.iterdir()):
+                break
+            directory.rmdir()
+
+
+COMPRESSED_EXTENSIONS = {'.html', '.css', '.xml', '.svg', '.js'}
+_COMPRESSORS = {'.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+if brotli is not None:
+    _COMPRESSORS['.br'] = lambda data: brotli.compress(data, quality=11)
+
+
+def _compress_output(path, previous):
+    """
+    Write precompressed siblings of the deployed file ``path``, unless its
+    contents are unchanged since the ``previous`` manifest entry.  Returns the
+    new manifest entry.
+    """
+    source = DEPLOY_DIRECTORY / path
+    with open(source, "rb") as file:
+        data = file.read()
+    inputs = {
+        'source': hashlib.blake2b(data, digest_size=16).hexdigest(),
+        'formats': sorted(_COMPRESSORS),
+    }
+    entry = {'signature': _digest(inputs), 'inputs': inputs,
+             'outputs': [path + suffix for suffix in _COMPRESSORS]}
+    if not _up_to_date(entry, previous):
+        for suffix, compress in _COMPRESSORS.items():
+            destination = source.with_name(source.name + suffix)
+            _unlink(destination)
+            with open(destination, "wb") as file:
+                file.write(compress(data))
+    return entry
+
+
+def _compress_outputs(entries, previous, jobs):
+    paths = sorted(
+        path for entry in entries.values() for path in entry['outputs']
+        if pathlib.PurePosixPath(path).suffix.lower() in COMPRESSED_EXTENSIONS
+    )
+    # zlib and brotli release the GIL while compressing, so threads suffice.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        compressed = list(pool.map(
+            lambda path: _compress_output(path, previous.get('compress:' + path)),
+            paths))
+    for path, entry in zip(paths, compressed):
+        entries['compress:' + path] = entry
+
+
+_worker_state = None
+
+
+def _configure(vars):
+    """Set the module-level deploy options from the command-line ``vars``."""
+    global _copy_asset, _minify_html, _inline_css, _responsive_images
+    _copy_asset = ASSET_COPY_FUNCTIONS[vars.get('link') or 'copy']
+    _minify_html = minify.HTML_MINIFIERS[vars.get('minifier') or 'tokenise']
+    _inline_css = bool(vars.get('critical_css'))
+    _responsive_images = bool(vars.get('responsive_images'))
+    _page_options.clear()
+    _page_options['minifier'] = _minify_html.__name__
+    _page_options['critical_css'] = _inline_css
+    _page_options['responsive_images'] = _responsive_images
+
+
+def _set_worker_state(state, vars):
+    global _worker_state
+    _worker_state = state
+    _configure(vars)
+
+
+def _run_deploy_task(task, state=None):
+    function, *args = task
+    return function(*args, state or _worker_state)
+
+
+def deploy_site(*, vars):
+    _configure(vars)
+    previous = _read_deploy_manifest() if vars.get('incremental') else {}
+    if not previous:
+        # Without a manifest there is no way to know which files in an
+        # existing deployment are stale, so start again from scratch.
+        try:
+            shutil.rmtree(DEPLOY_DIRECTORY)
+        except FileNotFoundError:
+            pass
+    entries = {}
+    font_subsets = {}
+    if vars.get('subset_fonts'):
+        if fonts.available():
+            font_subsets, entries = _subset_fonts(previous)
+        else:
+            print("Subsetting fonts needs the 'fontTools' and 'brotli' modules;"
+                  " deploying the full fonts instead.", file=sys.stderr)
+    if _responsive_images and not images.available():
+        print("Resizing images needs the 'Pillow' module; images will only"
+              " be marked to load lazily.", file=sys.stderr)
+    assets = _template_assets(vars.get('fingerprint'), font_subsets)
+    state = SiteState(STORE_FILE, TEMPLATE_DIRECTORY / TEMPLATE_HTML, assets)
+    entries.update(_deploy_template(previous, assets, font_subsets))
+    if _inline_css:
+        # Pages include the stylesheets' contents, so depend on them.
+        _page_options['stylesheets'] = _digest(sorted(
+            entry['signature'] for key, entry in entries.items()
+            if key.endswith('.css')
+        ))
+    if vars.get('fingerprint'):
+        entries['assets'] = _write_asset_manifest(assets, previous.get('assets'))
+
+    tasks = []
+    for task in _deploy_tasks(state):
+        key, entry = _task_manifest(task, state)
+        if _up_to_date(entry, previous.get(key)):
+            entry['outputs'] = previous[key]['outputs']
+        else:
+            tasks.append((key, task))
+        entries[key] = entry
+
+    jobs = min(vars.get('jobs') or os.cpu_count() or 1, len(tasks))
+    if jobs > 1:
+        # The state is sent to each worker once, when it starts, rather than
+        # with every task.
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_set_worker_state,
+                initargs=(state, vars)) as pool:
+            outputs = list(pool.map(_run_deploy_task,
+                                    [task for _, task in tasks]))
+    else:
+        outputs = [_run_deploy_task(task, state) for _, task in tasks]
+    for (key, _), paths in zip(tasks, outputs):
+        entries[key]['outputs'] = paths
+
+    if vars.get('compress'):
+        _compress_outputs(entries, previous, vars.get('jobs') or os.cpu_count())
+    _remove_stale_outputs(previous, entries)
+    _write_deploy_manifest(entries)
     return 0
+
+
+# Temporary files that editors write alongside the files being edited.
+_EDITOR_FILES = re.compile(r'^\.#|^#.*#$|~$|\.sw[a-p]$|^4913$')
+
+
+def _article_directory(path):
+    """The directory of the article that ``path`` belongs to, if any."""
+    for directory in (path, *path.parents):
+        if (directory / INFO_FILE).is_file():
+            return directory
+        if directory == ARTICLES_DIRECTORY:
+            break
+    return None
+
+
+def _update_changed(changed, vars):
+    """
+    Update the articles containing the ``changed`` paths (all of them, if it is
+    None).  Returns False if none of the changes can affect the site.
+    """
+    if changed is None:
+        update_all_articles(vars=vars)
+        return True
+    changed = [
+        path for path in changed
+        if path.name != METADATA_FILE.name and not _EDITOR_FILES.search(path.name)
+    ]
+    if not changed:
+        return False
+    articles = {_article_directory(path) for path in changed} - {None}
+    for article in sorted(articles):
+        try:
+            update_article(article, vars=vars)
+        except ValueError as error:
+            print(f"{article}: {error}", file=sys.stderr)
+    return True
+
+
+def _wait_for_changes(watcher, timeout=None):
+    """
+    Wait for ``watcher`` to see changes, for at most ``timeout`` seconds.
+    Saving a file often touches it (and others) several times in quick
+    succession, so these are all collected together.
+    """
+    changed = watcher.wait(timeout)
+    while changed:
+        more = watcher.wait(0.05)
+        if more is None:
+            return None
+        if not more:
+            break
+        changed |= more
+    return changed
+
+
+def _rebuild(changed, vars):
+    """
+    Update the articles containing the ``changed`` paths (all of them, if it is
+    None) and deploy again.  Returns whether anything was done.
+    """
+    if not _update_changed(changed, vars):
+        return False
+    # Few pages change at a time, so the deploy is done in this process, which
+    # keeps the Markdown, KaTeX and Pygments state warm.
+    deploy_site(vars={**vars, 'incremental': True, 'jobs': 1})
+    return True
+
+
+def watch(*, vars):
+    """
+    Update and deploy the site, then do it again whenever an article, the
+    template or the global store changes, until interrupted.
+    """
+    watcher = filewatch.watcher([ARTICLES_DIRECTORY, TEMPLATE_DIRECTORY, STORE_FILE])
+    try:
+        changed = None
+        while True:
+            start = time.perf_counter()
+            try:
+                rebuilt = _rebuild(changed, vars)
+            except Exception:
+                # Keep watching; the next save will probably fix it.
+                traceback.print_exc()
+            else:
+                if rebuilt:
+                    print(f"Rebuilt in {time.perf_counter() - start:.2f}s;"
+                          " watching for changes.", flush=True)
+            changed = _wait_for_changes(watcher)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+_RENDER_FUNCTIONS = {
+    _deploy_main_page: _render_main_page,
+    _deploy_article: _render_article,
+    _deploy_tag: _render_tag,
+    _deploy_about: _render_about,
+    _deploy_feed: _render_feed,
+}
+
+
+def _page_number(parts, article_ids):
+    """The list page at the path ``parts`` below the list, if it exists."""
+    if not parts:
+        return 1
+    if len(parts) != 2 or parts[0] != 'page' or not parts[1].isdigit():
+        return None
+    page = int(parts[1])
+    return page if 1 < page <= _page_count(article_ids) else None
+
+
+def _page_task(path, state):
+    """The deploy task that writes ``path`` in the deployment, if any."""
+    if path == FEED_LOCATION:
+        return (_deploy_feed,)
+    directory, _, name = path.rpartition('/')
+    if name != 'index.html':
+        return None
+    parts = directory.split('/') if directory else []
+    if parts == [ABOUT_DIRECTORY.name]:
+        return (_deploy_about,)
+    if not parts or parts[0] == 'page':
+        page = _page_number(parts, state.newest())
+        return None if page is None else (_deploy_main_page, page)
+    if parts[0] == 'tags' and len(parts) > 1:
+        for tag in state.tags():
+            if _sanitise_tag(tag) == parts[1]:
+                page = _page_number(parts[2:], state.newest_in_tag(tag))
+                return None if page is None else (_deploy_tag, tag, page)
+        return None
+    for article_id in state.article_ids():
+        if state.article_info(article_id).output_path.strip('/') == directory:
+            return (_deploy_article, article_id)
+    return None
+
+
+class _PreviewSite:
+    """
+    The site as the preview server sees it: files are rendered on demand from
+    the stores and the template, and kept in memory until something changes.
+    """
+    def __init__(self):
+        self._state = SiteState(STORE_FILE, TEMPLATE_DIRECTORY / TEMPLATE_HTML)
+        self._files = {}
+
+    def render(self, url):
+        path = url.lstrip('/')
+        if not path or path.endswith('/'):
+            path += 'index.html'
+        if path not in self._files:
+            task = _page_task(path, self._state)
+            if task is not None:
+                function, *args = task
+                for output, text in _RENDER_FUNCTIONS[function](*args, self._state):
+                    self._files[output] = text.encode('utf-8')
+            else:
+                source = self._static_file(path)
+                if source is None:
+                    return None
+                self._files[path] = source.read_bytes()
+        return self._files.get(path)
+
+    def _static_file(self, path):
+        source = self._state.article_file('/' + path)
+        if source is not None:
+            return source
+        source = TEMPLATE_DIRECTORY / path
+        if source.is_file() and source.name not in IGNORED_TEMPLATE_FILES:
+            return source
+        return None
+
+    def refresh(self, changed, vars):
+        """
+        Update the articles affected by the ``changed`` paths and forget every
+        rendered file.  Returns whether the site may have changed.
+        """
+        if not _update_changed(changed, vars):
+            return False
+        self._state = SiteState(STORE_FILE, TEMPLATE_DIRECTORY / TEMPLATE_HTML)
+        self._files.clear()
+        return True
+
+
+def serve(*, vars):
+    """
+    Serve a preview of the site over HTTP, rendering pages from memory rather
+    than deploying them.  Pages reload themselves whenever the articles or the
+    template change.  Runs until interrupted.
+    """
+    # Only the options that need nothing from a deployment apply.
+    _configure({'minifier': vars.get('minifier')})
+    update_all_articles(vars=vars)
+    site = _PreviewSite()
+    # The Markdown instances aren't thread-safe, so rendering and updating
+    # happen one at a time in this one thread.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    watcher = filewatch.watcher([ARTICLES_DIRECTORY, TEMPLATE_DIRECTORY, STORE_FILE])
+    preview = server.PreviewServer(site.render, executor, port=vars.get('port') or 8000)
+
+    async def main():
+        listener = await preview.start()
+        print(f"Serving on http://{preview.host}:{preview.port}/", flush=True)
+        loop = asyncio.get_running_loop()
+        async with listener:
+            while True:
+                # The timeout lets the thread finish promptly on shutdown.
+                changed = await loop.run_in_executor(
+                    None, _wait_for_changes, watcher, 0.5)
+                if changed == set():
+                    continue
+                try:
+                    refreshed = await loop.run_in_executor(
+                        executor, site.refresh, changed, vars)
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                if refreshed:
+                    preview.reload()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+        executor.shutdown(wait=False)
+
+
+def _task_label(task, state=None):
+    """The unit of work a deploy task is profiled as."""
+    function, *args = task
+    if function is _deploy_article:
+        # The same as when the article was updated.
+        return (state or _worker_state).article_info(args[0]).input_path
+    return _task_key(task)
+
+
+@contextlib.contextmanager
+def profiling(dump=None):
+    """
+    Time the phases of the build done inside the context (KaTeX, Pygments,
+    Markdown, minifying, checksumming and copying) for each article and page,
+    and print a report at the end.  If ``dump`` is given, also write a profile
+    there: the phases for speedscope if it ends in ``.json``, and otherwise
+    the statistics of running under `cProfile`.
+    """
+    module = sys.modules[__name__]
+    timing.instrument_unit(module, 'update_article', lambda path, **_: str(path))
+    timing.instrument_unit(module, '_run_deploy_task', _task_label)
+    timing.instrument(katex, 'render_many', 'katex')
+    timing.instrument(katex, 'tohtml', 'katex')
+    timing.instrument(highlight, 'tohtml', 'pygments')
+    timing.instrument(summarise, 'convert', 'markdown')
+    timing.instrument(_markdown, 'convert', 'markdown')
+    timing.instrument(_summarise, 'convert', 'markdown')
+    timing.instrument(module, '_postprocess_html', 'minify')
+    timing.instrument(module, '_checksum_directory', 'checksum')
+    timing.instrument(shutil, 'copytree', 'copy')
+    timing.instrument(module, '_copy_with_filter', 'copy')
+    timing.instrument(module, '_copy_minified_css', 'copy')
+    timing.instrument(module, '_copy_asset', 'copy')
+    # The deploy options pick copy functions out of these tables.
+    for table in (ASSET_COPY_FUNCTIONS, _FILE_COPY_FILTERS):
+        for name in table:
+            timing.instrument(table, name, 'copy')
+    profiler = None
+    if dump is not None and not str(dump).endswith('.json'):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(dump)
+        elif dump is not None:
+            timing.write_speedscope(dump, "build")
+        timing.report(total)
+        timing.restore()
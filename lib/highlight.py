@@ -1,12 +1,20 @@
+import functools
 import re
 import warnings
 
 import markdown
+import pygments
 import pygments.lexers
-from pygments.formatters.html import _get_ttype_class, escape_html
+from pygments.formatters.html import _escape_html_table, _get_ttype_class
+
+from . import cache
 
 CLASS = 'chl'
 _TOKEN_CLASS_MAP = {}
+# Bump this whenever a change here alters the HTML made from the same input,
+# so stale entries in the cache of highlighted code are not used.
+_FORMAT_VERSION = 2
+_cache = cache.Cache('highlight', max_bytes=64 * 1024 * 1024)
 
 
 def _token_to_class(token):
@@ -19,44 +27,91 @@ def _token_to_class(token):
     return out
 
 
-def _span(class_, code):
-    if not code:
-        return []
+def _fragment(class_, text):
+    """
+    The HTML of a run of text with a single class.  A span that crosses a line
+    break is closed at the end of the line and reopened on the next.
+    """
+    text = text.translate(_escape_html_table)
     if not class_:
-        return [code]
-    return ['<span class="{}">'.format(class_), code, '</span>']
-
-
-def _format_lines(tokens):
-    line = []
+        return text
+    start = '<span class="' + class_ + '">'
+    text = start + text.replace('\n', '</span>\n' + start) + '</span>'
+    return text.replace(start + '</span>', '')
+
+
+def _format(tokens):
+    """
+    Format a token stream as HTML in one pass, returning the HTML and its
+    number of lines, with no trailing line break.  Adjacent tokens with the
+    same class share a span, and the HTML of each distinct run of text is only
+    built once.
+    """
+    fragments, out = {}, []
+    current, run = None, []
     for token, text in tokens:
-        class_ = _token_to_class(token)
-        escaped = escape_html(text).split('\n')
-        if len(escaped) == 1:
-            line += _span(class_, escaped[0])
+        class_ = _TOKEN_CLASS_MAP.get(token)
+        if class_ is None:
+            class_ = _token_to_class(token)
+        if class_ == current:
+            run.append(text)
             continue
-        first, *middle, last = escaped
-        yield "".join(line + _span(class_, first))
-        yield from ("".join(_span(class_, mid)) for mid in middle)
-        line = _span(class_, last)
-    if line:
-        yield "".join(line)
-
-
-def tohtml(code, language, start_line=1):
+        if run:
+            key = (current, run[0] if len(run) == 1 else ''.join(run))
+            try:
+                out.append(fragments[key])
+            except KeyError:
+                out.append(fragments.setdefault(key, _fragment(*key)))
+        current, run = class_, [text]
+    if run:
+        out.append(_fragment(current, ''.join(run)))
+    out = ''.join(out)
+    if not out:
+        return '', 0
+    if out[-1] == '\n':
+        out = out[:-1]
+    return out, out.count('\n') + 1
+
+
+@functools.lru_cache(maxsize=None)
+def _find_lexer(language):
     try:
-        lexer = pygments.lexers.get_lexer_by_name(language)
+        return pygments.lexers.get_lexer_by_name(language)
     except pygments.util.ClassNotFound:
+        return None
+
+
+def _get_lexer(language):
+    # The warning is outside the memoised lookup (and the cache of highlighted
+    # code), so that an unknown language is reported on every build.
+    lexer = _find_lexer(language)
+    if lexer is None:
         warnings.warn("unknown language: " + language)
-        lexer = pygments.lexers.get_lexer_by_name('text')
-    lines = list(_format_lines(lexer.get_tokens(code)))
+        lexer = _find_lexer('text')
+    return lexer
+
+
+def tohtml(code, language, start_line=1):
+    lexer = _get_lexer(language)
+    key = _cache.key(_FORMAT_VERSION, pygments.__version__, language,
+                     start_line, code)
+    cached = _cache.get(key)
+    if cached is not None:
+        return cached.decode('utf-8')
+    out = _highlight(code, lexer, start_line)
+    _cache.put(key, out.encode('utf-8'))
+    return out
+
+
+def _highlight(code, lexer, start_line):
+    code, n_lines = _format(lexer.get_tokens(code))
     numbers = (
         '<code class="line-numbers" aria-hidden="true">'
-        + "\n".join(str(n) for n in range(start_line, start_line + len(lines)))
+        + "\n".join(map(str, range(start_line, start_line + n_lines)))
         + '</code>'
     )
     highlighted = "".join([
-        '<code class="highlighted-code">', '\n'.join(lines), '</code>',
+        '<code class="highlighted-code">', code, '</code>',
     ])
     return "".join([
         f'<pre class="{CLASS}">', numbers, highlighted, '</pre>',
@@ -71,30 +126,32 @@ class CodeBlock(markdown.preprocessors.Preprocessor):
         self._config = re.compile(r'(?P<language>\w*)\s*')
 
     def run(self, lines):
-        out, lines = [], list(reversed(lines))
-        while lines:
-            line = lines.pop()
-            start_match = self._start.match(line)
-            if not start_match:
+        # Every fence contains three backticks, so the (much faster) substring
+        # test rules out almost all lines before any regex is tried.
+        ends = [i for i, line in enumerate(lines)
+                if '```' in line and self._end.search(line)]
+        out, ptr, next_end = [], 0, 0
+        while ptr < len(lines):
+            line = lines[ptr]
+            if '```' not in line or not self._start.match(line):
                 out.append(line)
+                ptr += 1
                 continue
-            first_line = line
+            while next_end < len(ends) and ends[next_end] <= ptr:
+                next_end += 1
+            if next_end == len(ends):
+                # Failed to find closing code block.  Nothing after here can
+                # close a block either, so the rest is all ordinary text.
+                out.extend(lines[ptr:])
+                break
+            end = ends[next_end]
             config = self._config.match(self._start.sub('', line))
             language = config.group('language') or 'text'
-            code = []
-            while True:
-                if not lines:
-                    # Failed to find closing code block.
-                    out.append(first_line)
-                    lines = list(reversed(code))
-                    break
-                line = lines.pop()
-                if self._end.search(line):
-                    code.append(self._end.sub('', line))
-                    html = tohtml('\n'.join(code), language)
-                    out.append(self.md.htmlStash.store(html))
-                    break
-                code.append(line)
+            code = lines[ptr + 1 : end]
+            code.append(self._end.sub('', lines[end]))
+            html = tohtml('\n'.join(code), language)
+            out.append(self.md.htmlStash.store(html))
+            ptr = end + 1
         return out
 
 
@@ -0,0 +1,190 @@
+"""
+Responsive versions of the images in articles: smaller copies of raster images
+for `srcset`, and the intrinsic sizes and lazy loading of every image.  Making
+the smaller copies and reading raster sizes needs the optional `Pillow`
+package; without it, images are only marked to load lazily.
+"""
+
+import functools
+import hashlib
+import html
+import io
+import re
+
+try:
+    import PIL
+    import PIL.features
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+from . import cache
+
+__all__ = ['available', 'derivatives', 'resized', 'responsive']
+
+# Widths (in CSS pixels) of the smaller copies.  Copies are only made at widths
+# smaller than the original.
+WIDTHS = (480, 960, 1440)
+# Articles are at most this wide, and take the whole screen below it.
+SIZES = "(max-width: 800px) 100vw, 800px"
+RASTER_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+
+# Bump whenever the way derivatives are made changes.
+_FORMAT_VERSION = 1
+_cache = cache.Cache('images', 128 * 1024 * 1024)
+
+_img = re.compile(r'<img\b((?:[^>"\']|"[^"]*"|\'[^\']*\')*?)\s*(/?)>', re.IGNORECASE)
+_attribute = re.compile(
+    r'''([^\s"'=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?''')
+_svg_root = re.compile(rb'<svg\b[^>]*>')
+_svg_length = re.compile(rb'''\b(width|height)\s*=\s*["']\s*([\d.]+)\s*(?:px)?\s*["']''')
+_svg_view_box = re.compile(
+    rb'''\bviewBox\s*=\s*["']\s*[-\d.]+[\s,]+[-\d.]+[\s,]+([\d.]+)[\s,]+([\d.]+)''')
+
+
+def available():
+    """Whether raster images can be resized in this environment."""
+    return PIL is not None
+
+
+def _format():
+    if PIL.features.check('webp'):
+        return 'WEBP', '.webp'
+    return 'PNG', '.png'
+
+
+def _svg_size(path):
+    with open(path, "rb") as file:
+        root = _svg_root.search(file.read(4096))
+    if root is None:
+        return None
+    lengths = dict(_svg_length.findall(root[0]))
+    if b'width' in lengths and b'height' in lengths:
+        return round(float(lengths[b'width'])), round(float(lengths[b'height']))
+    view_box = _svg_view_box.search(root[0])
+    if view_box is not None:
+        return round(float(view_box[1])), round(float(view_box[2]))
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _size(path, mtime):
+    if path.suffix.lower() == '.svg':
+        return _svg_size(path)
+    if PIL is None or path.suffix.lower() not in RASTER_EXTENSIONS:
+        return None
+    with PIL.Image.open(path) as image:
+        return image.size
+
+
+def size(path):
+    """The intrinsic ``(width, height)`` of an image, or None if unknown."""
+    try:
+        return _size(path, path.stat().st_mtime_ns)
+    except (OSError, ValueError, SyntaxError):
+        return None
+
+
+def _widths(path):
+    if PIL is None or path.suffix.lower() not in RASTER_EXTENSIONS:
+        return []
+    dimensions = size(path)
+    if dimensions is None:
+        return []
+    return [width for width in WIDTHS if width < dimensions[0]]
+
+
+def _name(path, width):
+    return f"{path.stem}-{width}w{_format()[1]}"
+
+
+def _resize(data, width):
+    format_, _ = _format()
+    with PIL.Image.open(io.BytesIO(data)) as image:
+        height = round(image.height * width / image.width)
+        resized = image.resize((width, height), PIL.Image.LANCZOS)
+        if format_ == 'PNG' and resized.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            resized = resized.convert('RGBA')
+        out = io.BytesIO()
+        resized.save(out, format_, quality=85, method=6)
+    return out.getvalue()
+
+
+def derivatives(path):
+    """
+    The smaller copies of the image at ``path``, as ``(name, data)`` pairs to
+    be written alongside it.  These are cached by the content of the image.
+    """
+    widths = _widths(path)
+    if not widths:
+        return []
+    with open(path, "rb") as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    out = []
+    for width in widths:
+        key = _cache.key(_FORMAT_VERSION, PIL.__version__, _format()[0],
+                         digest, width)
+        resized = _cache.get(key)
+        if resized is None:
+            resized = _resize(data, width)
+            _cache.put(key, resized)
+        out.append((_name(path, width), resized))
+    return out
+
+
+def _attributes(text):
+    out = {}
+    for match in _attribute.finditer(text):
+        value = next((group for group in match.groups()[1:] if group is not None), None)
+        out[match[1].lower()] = value
+    return out
+
+
+def resized(text, resolve):
+    """
+    The source files of the images in the HTML ``text`` that `responsive`
+    gives a `srcset` of smaller copies, and so that need `derivatives`.
+    """
+    out = set()
+    for match in _img.finditer(text):
+        attributes = _attributes(match[1])
+        src = attributes.get('src')
+        path = src and resolve(html.unescape(src))
+        if path is not None and 'srcset' not in attributes and _widths(path):
+            out.add(path)
+    return out
+
+
+def responsive(text, resolve):
+    """
+    Add intrinsic sizes, lazy loading and (for raster images) a `srcset` of
+    their smaller copies to the `<img>` tags in the HTML ``text``.  ``resolve``
+    takes the URL of an image and returns its source file, or None if it isn't
+    one of the site's own.
+    """
+    def replace(match):
+        attributes = _attributes(match[1])
+        src = attributes.get('src')
+        path = src and resolve(html.unescape(src))
+        if path is None:
+            return match[0]
+        extra = []
+        if 'loading' not in attributes:
+            extra.append('loading="lazy"')
+        if 'decoding' not in attributes:
+            extra.append('decoding="async"')
+        dimensions = size(path)
+        if dimensions is not None and not ({'width', 'height'} & attributes.keys()):
+            extra.append(f'width="{dimensions[0]}" height="{dimensions[1]}"')
+        widths = _widths(path)
+        if widths and 'srcset' not in attributes:
+            base = src.rsplit('/', 1)[0]
+            candidates = [f"{base}/{_name(path, width)} {width}w" for width in widths]
+            candidates.append(f"{src} {dimensions[0]}w")
+            extra.append(f'srcset="{", ".join(candidates)}" sizes="{SIZES}"')
+        if not extra:
+            return match[0]
+        return f'<img{match[1]} {" ".join(extra)}{match[2]}>'
+
+    return _img.sub(replace, text)
@@ -1,25 +1,229 @@
+import atexit
+import json
 import os
 import pathlib
+import queue
 import re
+import shutil
 import subprocess
+import threading
 from xml.etree import ElementTree as etree
 
 import markdown
 
+from . import cache
 
-_NODEBIN = pathlib.Path('node_modules/.bin')
-_KATEX = (pathlib.Path(__file__).parents[1] / _NODEBIN / 'katex').absolute()
-if not (_KATEX.is_file() and os.access(_KATEX, os.X_OK)):
-    raise ImportError("Could not locate KaTeX binary.")
+_ROOT = pathlib.Path(__file__).parents[1]
+_KATEX_MODULE = (_ROOT / 'node_modules' / 'katex').absolute()
+_SERVER_SCRIPT = (pathlib.Path(__file__).parent / 'katex_server.js').absolute()
+_NODE = shutil.which('node')
+if _NODE is None or not (_KATEX_MODULE / 'package.json').is_file():
+    raise ImportError("Could not locate KaTeX.")
+with open(_KATEX_MODULE / 'package.json', 'r') as _file:
+    KATEX_VERSION = json.load(_file)['version']
 
 
-def tohtml(latex, inline):
-    args = (_KATEX,) + (() if inline else ('-d',))
-    result = subprocess.run(args, input=latex, text=True, capture_output=True,
-                            check=False)
-    if result.returncode != 0:
-        raise OSError(f"KaTeX failed on input:\n\n{latex}\n\n{result.stderr}")
-    return result.stdout.strip()
+class KaTeXServer:
+    """
+    A long-lived Node process running ``katex_server.js``, which renders
+    equations sent to it as newline-framed JSON.  Requests are pipelined: all
+    batches are written before any response is awaited, and a reader thread
+    drains the responses so neither side can block on a full pipe.  The process
+    is started lazily on first use (and again in any forked child process), and
+    is restarted once if it dies while work is outstanding.
+    """
+    batch_size = 64
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._process = None
+        self._responses = None
+        self._finished = None
+        self._pid = None
+        self._next_id = 0
+
+    def _forget(self):
+        # Called in a freshly forked child: the parent's server belongs to the
+        # parent, so just drop our copies of its pipes.
+        self._lock = threading.Lock()
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.stdout.close()
+        self._process = None
+
+    def _stop(self):
+        """Kill the server, if this process started it, and reap it."""
+        if self._process is not None and self._pid == os.getpid():
+            self._process.kill()
+            self._process.wait()
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+        self._process = None
+
+    def _start(self):
+        self._stop()
+        self._process = subprocess.Popen(
+            (_NODE, str(_SERVER_SCRIPT)), cwd=_ROOT,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+        self._pid = os.getpid()
+        self._responses = queue.Queue()
+        self._finished = threading.Event()
+        threading.Thread(
+            target=self._read,
+            args=(self._process.stdout, self._responses, self._finished),
+            daemon=True,
+        ).start()
+
+    @staticmethod
+    def _read(stream, responses, finished):
+        # Read the raw descriptor rather than iterating the buffered stream, so
+        # this thread never holds a lock that a forked child would inherit.
+        fd, pending = stream.fileno(), b''
+        try:
+            while chunk := os.read(fd, 1 << 16):
+                *lines, pending = (pending + chunk).split(b'\n')
+                for line in lines:
+                    response = json.loads(line)
+                    if not isinstance(response, dict):
+                        raise ValueError("malformed response")
+                    responses.put(response)
+        except ValueError:
+            # Once the output is garbled, responses can't be matched to their
+            # requests any more, so treat the server as dead.
+            pass
+        finally:
+            # Always wake up whoever is waiting on the responses.
+            finished.set()
+            responses.put(None)
+            stream.close()
+
+    def _running(self):
+        # Node can outlive the reader (after garbled output, or between closing
+        # its stdout and exiting), but then nothing would collect its responses.
+        return (self._process is not None
+                and self._pid == os.getpid()
+                and self._process.poll() is None
+                and not self._finished.is_set())
+
+    def close(self):
+        with self._lock:
+            if self._process is not None and self._pid == os.getpid():
+                self._process.stdin.close()
+                self._process.wait()
+            self._process = None
+
+    def _submit(self, batches):
+        """Write every batch, then collect the responses for them."""
+        if not self._running():
+            self._start()
+        ids = {}
+        try:
+            for batch in batches:
+                self._next_id += 1
+                ids[self._next_id] = batch
+                request = {
+                    'id': self._next_id,
+                    'items': [{'latex': latex, 'display': not inline}
+                              for latex, inline in batch],
+                }
+                self._process.stdin.write(json.dumps(request).encode() + b'\n')
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        out = {}
+        while len(out) < len(ids):
+            response = self._responses.get()
+            if response is None:
+                break
+            out[response['id']] = response['results']
+        return [out.get(id_) for id_ in ids]
+
+    def render(self, items):
+        """
+        Render a sequence of ``(latex, inline)`` pairs, returning a list of
+        ``(html, error)`` pairs in the same order, where exactly one of each
+        pair is ``None``.
+        """
+        items = list(items)
+        batches = [items[ptr : ptr + self.batch_size]
+                   for ptr in range(0, len(items), self.batch_size)]
+        with self._lock:
+            results = self._submit(batches)
+            missing = [batch for batch, result in zip(batches, results)
+                       if result is None]
+            if missing:
+                # The server died underneath us.  Give it one more chance.
+                self._stop()
+                retried = iter(self._submit(missing))
+                results = [next(retried) if result is None else result
+                           for result in results]
+                if None in results:
+                    self._stop()
+        out = []
+        for batch, result in zip(batches, results):
+            if result is None:
+                raise OSError("KaTeX server exited unexpectedly while rendering:"
+                              "\n\n" + "\n".join(latex for latex, _ in batch))
+            out.extend((x.get('html'), x.get('error')) for x in result)
+        return out
+
+
+_server = KaTeXServer()
+atexit.register(_server.close)
+os.register_at_fork(after_in_child=_server._forget)
+
+
+_cache = cache.Cache('katex', max_bytes=64 * 1024 * 1024)
+
+
+def _cache_key(latex, inline):
+    return _cache.key(KATEX_VERSION, inline, latex)
+
+
+def _error(latex, message):
+    return OSError(f"KaTeX failed on input:\n\n{latex}\n\n{message}")
+
+
+def render_many(items):
+    """
+    Render an iterable of ``(latex, inline)`` pairs in one go, returning a
+    dictionary mapping each pair to either its HTML or the ``OSError`` that
+    rendering it would raise.  Anything not already in the on-disk cache is
+    sent to the KaTeX server as a single pipelined request.
+    """
+    out, missing = {}, []
+    for item in dict.fromkeys(items):
+        cached = _cache.get(_cache_key(*item))
+        if cached is None:
+            missing.append(item)
+        else:
+            out[item] = cached.decode('utf-8')
+    if missing:
+        for item, (html, error) in zip(missing, _server.render(missing)):
+            if error is None:
+                html = html.strip()
+                _cache.put(_cache_key(*item), html.encode('utf-8'))
+                out[item] = html
+            else:
+                out[item] = _error(item[0], error)
+    return out
+
+
+def tohtml(latex, inline, rendered=None):
+    """
+    Render a single equation, using the results of an earlier call to
+    `render_many` if they are given and contain it.
+    """
+    item = (latex, inline)
+    if rendered is None or item not in rendered:
+        rendered = render_many([item])
+    out = rendered[item]
+    if isinstance(out, OSError):
+        raise out
+    return out
 
 
 def stash_mathml(stash, element):
@@ -45,21 +249,67 @@ def stash_mathml(stash, element):
     parent.text = placeholder + (parent.text or "")
 
 
+_INLINE_PATTERN = r'\$`(.*?)`\$'
+_BLOCK_START = re.compile(r'^\s*\\\[')
+_BLOCK_END = re.compile(r'\\\]\s*$')
+
+
+class KaTeXPrefetch(markdown.preprocessors.Preprocessor):
+    """
+    Find everything that looks like inline or display maths in the whole
+    document up front, and render it all as one batch, so the inline and block
+    processors only have to look up their results.  The scan mirrors how those
+    processors split the text; anything it misses is simply rendered on demand.
+    """
+    def __init__(self, md, rendered):
+        super().__init__(md)
+        self._inline = re.compile(_INLINE_PATTERN, re.DOTALL | re.UNICODE)
+        self._rendered = rendered
+
+    def _find(self, text):
+        blocks = text.split('\n\n')
+        ptr = 0
+        while ptr < len(blocks):
+            block = blocks[ptr]
+            if _BLOCK_START.match(block):
+                out = [_BLOCK_START.sub('', block)]
+                for end in range(ptr, len(blocks)):
+                    if end > ptr:
+                        out.append(blocks[end])
+                    if _BLOCK_END.search(out[-1]):
+                        out[-1] = _BLOCK_END.sub('', out[-1])
+                        yield '\n'.join(out), False
+                        ptr = end + 1
+                        break
+                else:
+                    ptr += 1
+                continue
+            for match in self._inline.finditer(block):
+                yield match.group(1), True
+            ptr += 1
+
+    def run(self, lines):
+        self._rendered.clear()
+        self._rendered.update(render_many(self._find('\n'.join(lines))))
+        return lines
+
+
 class KaTeXInline(markdown.inlinepatterns.InlineProcessor):
-    def __init__(self, md):
-        pattern = r'\$`(.*?)`\$'
-        super().__init__(pattern, md)
+    def __init__(self, md, rendered):
+        super().__init__(_INLINE_PATTERN, md)
+        self._rendered = rendered
 
     def handleMatch(self, m, data):
-        el = etree.fromstring(tohtml(m.group(1), inline=True))
+        el = etree.fromstring(tohtml(m.group(1), True, self._rendered))
         stash_mathml(self.md.htmlStash, el)
         return el, m.start(0), m.end(0)
 
 
 class KaTeXBlock(markdown.blockprocessors.BlockProcessor):
-    def __init__(self, md, *args, **kwargs):
-        self._start = re.compile(r'^\s*\\\[')
-        self._end = re.compile(r'\\\]\s*$')
+    def __init__(self, md, rendered, *args, **kwargs):
+        self._start = _BLOCK_START
+        self._end = _BLOCK_END
+        self._rendered = rendered
         self.md = md
         super().__init__(md.parser, *args, **kwargs)
 
@@ -82,19 +332,35 @@ class KaTeXBlock(markdown.blockprocessors.BlockProcessor):
             blocks[0] = original_first
             return False
         del blocks[:n_blocks]
-        el = etree.fromstring(tohtml("\n".join(out), inline=False))
+        el = etree.fromstring(tohtml("\n".join(out), False, self._rendered))
         stash_mathml(self.md.htmlStash, el)
         parent.append(el)
         return True
 
 
 class Extension(markdown.extensions.Extension):
-    config = {}
+    def __init__(self, **kwargs):
+        self.config = {
+            'prefetch': [True, "Render all of a document's maths in one batch"
+                               " before parsing it."],
+        }
+        self._rendered = {}
+        super().__init__(**kwargs)
 
     def extendMarkdown(self, md):
+        if self.getConfig('prefetch'):
+            # Must run after the code-block preprocessor (25) has stashed the
+            # fenced code, so maths-like text inside code is not rendered.
+            md.preprocessors.register(KaTeXPrefetch(md, self._rendered),
+                                      'katex-prefetch', 15)
         # Backtick processor is priority 190, and we need to be higher.
-        md.inlinePatterns.register(KaTeXInline(md), 'katex-inline', 200)
+        md.inlinePatterns.register(KaTeXInline(md, self._rendered),
+                                   'katex-inline', 200)
         # This priority is pretty much entirely arbitrary, so long as it's
         # higher than paragraph (10).
-        md.parser.blockprocessors.register(KaTeXBlock(md), 'katex-block', 200)
+        md.parser.blockprocessors.register(KaTeXBlock(md, self._rendered),
+                                           'katex-block', 200)
         md.registerExtension(self)
+
+    def reset(self):
+        self._rendered.clear()
@@ -0,0 +1,40 @@
+// Long-lived KaTeX render server used by `lib/katex.py`.
+//
+// Requests and responses are framed as one JSON object per line on stdin and
+// stdout respectively.  A request looks like
+//
+//     {"id": 4, "items": [{"latex": "x^2", "display": false}, ...]}
+//
+// and is answered by exactly one response line with the same id, in the same
+// order as the requests were received:
+//
+//     {"id": 4, "results": [{"html": "<span ..."}, {"error": "..."}, ...]}
+//
+// Any number of requests may be in flight at once.
+
+"use strict";
+
+const katex = require("katex");
+const readline = require("readline");
+
+function render(item) {
+    try {
+        return {html: katex.renderToString(item.latex, {
+            displayMode: Boolean(item.display),
+            throwOnError: true,
+        })};
+    } catch (error) {
+        return {error: String(error && error.message ? error.message : error)};
+    }
+}
+
+const input = readline.createInterface({input: process.stdin, terminal: false});
+input.on("line", (line) => {
+    if (!line.trim()) {
+        return;
+    }
+    const request = JSON.parse(line);
+    const response = {id: request.id, results: request.items.map(render)};
+    process.stdout.write(JSON.stringify(response) + "\n");
+});
+input.on("close", () => process.exit(0));
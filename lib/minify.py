@@ -0,0 +1,167 @@
+"""
+HTML minifiers used when deploying pages.  Each backend is a function taking
+the text of a page and returning it minified, with runs of slashes in `href`
+attributes collapsed (other than the one after a URL scheme).
+"""
+
+import functools
+import re
+
+import css_html_js_minify
+
+__all__ = ['HTML_MINIFIERS', 'tokenise_html', 'legacy_html']
+
+# Elements whose text content is whitespace-sensitive.  Tags inside them are
+# still tidied, but the text between tags is left alone.
+_PRESERVE_WHITESPACE = frozenset(('pre', 'textarea'))
+# Elements whose content is not HTML at all, and so is copied verbatim.
+_RAW_TEXT = frozenset(('script', 'style'))
+# Tags which HTML allows to be omitted entirely.  They are only dropped when
+# they have no attributes.
+_OMITTED_TAGS = frozenset((
+    'html', 'head', 'body', 'tbody', '/html', '/head', '/body', '/tbody',
+    '/thead', '/tfoot', '/tr', '/td', '/th', '/li', '/dt', '/dd', '/option',
+    '/colgroup',
+    # Void elements, which never have a closing tag anyway.
+    '/area', '/base', '/br', '/col', '/hr', '/img', '/input', '/link',
+    '/meta', '/param',
+))
+_DEFAULT_TYPES = {
+    'script': ('text/javascript',),
+    'style': ('text/css',),
+}
+
+_token = re.compile(r"""
+    (?P<comment><!--.*?-->)
+  | (?P<declaration><![^>]*>)
+  | <(?P<closing>/?)(?P<name>[a-zA-Z][^\s/><]*)
+     (?P<attributes>(?:[^>"'<]|"[^"]*"|'[^']*')*?)
+     (?P<void>/?)>
+""", re.DOTALL | re.VERBOSE)
+_attribute = re.compile(r"""
+    (?P<name>[^\s"'=/>]+)
+    (?:\s*=\s*(?:"(?P<double>[^"]*)"|'(?P<single>[^']*)'|(?P<bare>[^\s>]+)))?
+""", re.VERBOSE)
+_unquotable = re.compile(r"[^\s\"'=<>`]+")
+# Attributes ending in an unquoted value, which takes in a following slash.
+_unquoted_end = re.compile(r"=\s*[^\s\"'=<>`]*$")
+_whitespace = re.compile(r"\s+")
+_slashes = re.compile(r'([^:])/+')
+
+
+# Pages repeat the same few tags (especially highlighted code spans) many times.
+@functools.lru_cache(maxsize=4096)
+def _tidy_tag(name, attributes, void):
+    out = ['<', name]
+    unquoted = False
+    for match in _attribute.finditer(attributes):
+        key = match['name']
+        value = match['double']
+        if value is None:
+            value = match['single']
+        if value is None:
+            value = match['bare']
+        if value is None:
+            out.append(' ' + key)
+            unquoted = False
+            continue
+        if key.lower() == 'href':
+            value = _slashes.sub(r'\1/', value)
+        elif (key.lower() == 'type'
+              and value.lower() in _DEFAULT_TYPES.get(name.lower(), ())):
+            continue
+        if _unquotable.fullmatch(value):
+            out.append(f' {key}={value}')
+            unquoted = True
+        elif '"' in value:
+            out.append(f" {key}='{value}'")
+            unquoted = False
+        else:
+            out.append(f' {key}="{value}"')
+            unquoted = False
+    if void:
+        # An unquoted value would otherwise swallow the slash.
+        out.append(' />' if unquoted else '/>')
+    else:
+        out.append('>')
+    return ''.join(out)
+
+
+def tokenise_html(text):
+    """
+    Minify HTML in a single pass over its tags.  Comments are removed (except
+    for conditional comments), runs of whitespace are collapsed to one space,
+    attributes are unquoted where that is unambiguous, and optional tags are
+    dropped.  The contents of `<pre>` and `<textarea>` are kept byte-for-byte
+    apart from the tags within them, and `<script>` and `<style>` contents are
+    not touched at all.  A `<` that doesn't start a tag is left as text.
+
+    >>> tokenise_html('<p>1 < 2 and x<y</p>')
+    '<p>1 < 2 and x<y</p>'
+    >>> tokenise_html('<a title=/>home</a> <br/>')
+    '<a title=/>home</a> <br/>'
+    """
+    out = []
+    preserve = 0
+    position = 0
+    length = len(text)
+    while position < length:
+        match = _token.search(text, position)
+        end = match.start() if match else length
+        if end > position:
+            chunk = text[position:end]
+            out.append(chunk if preserve else _whitespace.sub(' ', chunk))
+        if match is None:
+            break
+        position = match.end()
+        if match['comment'] is not None:
+            if match['comment'].startswith('<!--['):
+                out.append(match['comment'])
+            continue
+        if match['declaration'] is not None:
+            out.append(match['declaration'])
+            continue
+        name = match['name'].lower()
+        closing = match['closing']
+        if closing:
+            if name in _PRESERVE_WHITESPACE:
+                preserve = max(preserve - 1, 0)
+            if '/' + name not in _OMITTED_TAGS:
+                out.append(f'</{match["name"]}>')
+            continue
+        attributes, void = match['attributes'], match['void']
+        if void and _unquoted_end.search(attributes):
+            # As in `<a title=/>`, where the slash is the value.
+            attributes, void = attributes + void, ''
+        if name in _OMITTED_TAGS and not attributes.strip() and not void:
+            continue
+        out.append(_tidy_tag(match['name'], attributes, void))
+        if void:
+            continue
+        if name in _PRESERVE_WHITESPACE:
+            preserve += 1
+        elif name in _RAW_TEXT:
+            close = re.compile(r'</' + name + r'\s*>', re.IGNORECASE)
+            raw_end = close.search(text, position)
+            raw_end = raw_end.start() if raw_end else length
+            out.append(text[position:raw_end])
+            position = raw_end
+    return ''.join(out).strip()
+
+
+_url_tidyup_href = re.compile(r'href\s*=\s*([\'"])(.*?)\1')
+
+
+def legacy_html(text):
+    """
+    The original regex-based pipeline: tidy `href` attributes, then minify
+    with `css_html_js_minify`.
+    """
+    text = _url_tidyup_href.sub(lambda m: _slashes.sub(r'\1/', m[0]), text)
+    return css_html_js_minify.html_minify(text)
+
+
+HTML_MINIFIERS = {
+    'tokenise': tokenise_html,
+    'css-html-js-minify': legacy_html,
+}
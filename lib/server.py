@@ -0,0 +1,151 @@
+"""
+A small asyncio HTTP server for previewing the site.  It knows nothing about
+the site itself: every request is answered by a ``render(path)`` callback,
+and pages are told to reload themselves over server-sent events whenever
+`PreviewServer.reload` is called.
+"""
+
+import asyncio
+import mimetypes
+import posixpath
+import traceback
+import urllib.parse
+
+__all__ = ['PreviewServer', 'RELOAD_PATH']
+
+RELOAD_PATH = '/__reload'
+# Added to every HTML page, so it reloads when the site changes.
+_RELOAD_SCRIPT = (
+    "<script>new EventSource('" + RELOAD_PATH + "')"
+    ".addEventListener('reload', () => location.reload());</script>"
+).encode('utf-8')
+# Sent to idle event streams, so that proxies and browsers keep them open.
+_KEEPALIVE_SECONDS = 15
+
+_STATUS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+
+def _content_type(path):
+    if path.endswith('/') or path.endswith('.html'):
+        return 'text/html; charset=utf-8'
+    type_, _ = mimetypes.guess_type(path)
+    if type_ is None:
+        return 'application/octet-stream'
+    if type_.startswith('text/') or type_ in ('application/xml', 'image/svg+xml'):
+        return type_ + '; charset=utf-8'
+    return type_
+
+
+def _clean_path(target):
+    """The normalised path of a request target, or None if it is unsafe."""
+    path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+    if not path.startswith('/') or '\0' in path:
+        return None
+    clean = posixpath.normpath(path)
+    if clean.startswith('/..'):
+        return None
+    if path.endswith('/') and clean != '/':
+        clean += '/'
+    return clean
+
+
+class PreviewServer:
+    """
+    Serve the results of ``render`` over HTTP.  ``render`` is called with the
+    path of each request (with a leading slash, and ending in a slash for
+    directories) in the ``executor``, and returns the body as bytes, or None
+    if there is nothing at that path.
+    """
+    def __init__(self, render, executor, host='127.0.0.1', port=8000):
+        self._render = render
+        self._executor = executor
+        self.host = host
+        self.port = port
+        self._listeners = set()
+
+    def reload(self):
+        """Tell every open page to reload itself."""
+        for queue in self._listeners:
+            queue.put_nowait('reload')
+
+    async def _respond(self, writer, status, headers, body=b''):
+        lines = [f"HTTP/1.1 {status} {_STATUS[status]}"]
+        lines.extend(f"{key}: {value}" for key, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+
+    async def _events(self, writer):
+        queue = asyncio.Queue()
+        self._listeners.add(queue)
+        try:
+            await self._respond(writer, 200, {
+                'Content-Type': 'text/event-stream',
+                'Cache-Control': 'no-cache',
+                'Connection': 'keep-alive',
+            })
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), _KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    writer.write(b": keep-alive\n\n")
+                else:
+                    writer.write(f"event: {event}\ndata:\n\n".encode('utf-8'))
+                await writer.drain()
+        finally:
+            self._listeners.discard(queue)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            try:
+                method, target, _ = request.decode('latin-1').split()
+            except ValueError:
+                await self._respond(writer, 400, {'Content-Length': 0})
+                return
+            if method not in ('GET', 'HEAD'):
+                await self._respond(writer, 405, {'Allow': 'GET, HEAD',
+                                                  'Content-Length': 0})
+                return
+            path = _clean_path(target)
+            if path == RELOAD_PATH:
+                await self._events(writer)
+                return
+            body = None
+            if path is not None:
+                loop = asyncio.get_running_loop()
+                body = await loop.run_in_executor(self._executor, self._render, path)
+            if body is None:
+                status, type_, body = 404, 'text/plain; charset=utf-8', b'Not found\n'
+            else:
+                status, type_ = 200, _content_type(path)
+                if type_.startswith('text/html'):
+                    end = body.rfind(b'</body>')
+                    end = len(body) if end < 0 else end
+                    body = body[:end] + _RELOAD_SCRIPT + body[end:]
+            headers = {
+                'Content-Type': type_,
+                'Content-Length': len(body),
+                'Cache-Control': 'no-cache',
+                'Connection': 'close',
+            }
+            await self._respond(writer, status, headers,
+                                b'' if method == 'HEAD' else body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            traceback.print_exc()
+            await self._respond(writer, 500, {'Content-Length': 0})
+        finally:
+            writer.close()
+
+    async def start(self):
+        """Start listening, returning the `asyncio.Server`."""
+        return await asyncio.start_server(self._handle, self.host, self.port)
@@ -0,0 +1,147 @@
+import ast
+import collections.abc
+import functools
+import hashlib
+import json
+
+FORMAT = 'hbar-store'
+VERSION = 1
+# Keys whose values are large enough that they should only be read when they
+# are actually used.
+LARGE_FIELDS = ('markdown', 'summary')
+# Keys left out of the digest, since they only cache the stat of the article's
+# files: its contents are covered by the checksum.
+UNDIGESTED_FIELDS = ('files',)
+
+
+def _read_field(path, offset, length):
+    with open(path, "rb") as file:
+        file.seek(offset)
+        return json.loads(file.read(length))
+
+
+def _constant(value):
+    return value
+
+
+class Record(collections.abc.MutableMapping):
+    """
+    The stored state of one article.  Small metadata is loaded when the record
+    is read, but the rendered HTML in `LARGE_FIELDS` is only read from disk the
+    first time it is looked up.
+    """
+    def __init__(self, path, info, digest, body_start=0, fields=None):
+        self.path = path
+        self.digest = digest
+        self._info = info
+        self._body_start = body_start
+        self._fields = dict(fields or {})
+
+    def _load(self, key):
+        self._info[key] = self.loader(key)()
+        del self._fields[key]
+
+    def loader(self, key):
+        """
+        A picklable function that returns the value of ``key``.  Lazily loaded
+        values are read from disk afresh on every call, rather than being kept
+        in memory.
+        """
+        if key in self._fields:
+            offset, length = self._fields[key]
+            return functools.partial(_read_field, self.path,
+                                     self._body_start + offset, length)
+        return functools.partial(_constant, self._info[key])
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            self._load(key)
+        return self._info[key]
+
+    def __setitem__(self, key, value):
+        self._fields.pop(key, None)
+        self._info[key] = value
+
+    def __delitem__(self, key):
+        if self._fields.pop(key, None) is None:
+            del self._info[key]
+
+    def __contains__(self, key):
+        return key in self._info or key in self._fields
+
+    def __iter__(self):
+        # Looking values up while iterating may move keys from `_fields` to
+        # `_info`, so iterate over a snapshot.
+        return iter([*self._info, *self._fields])
+
+    def __len__(self):
+        return len(self._info) + len(self._fields)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.path}>"
+
+
+def _encode(value):
+    return json.dumps(value, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+def write(path, info):
+    """
+    Write an article's state to ``path``.  The first line is a JSON header
+    holding the format version, the small metadata, and the byte offsets of
+    the large fields, each of which follows on its own JSON line.
+    """
+    metadata, body, fields = {}, [], {}
+    offset = 0
+    for key in info:
+        if key in LARGE_FIELDS:
+            line = _encode(info[key])
+            fields[key] = [offset, len(line)]
+            offset += len(line)
+            body.append(line)
+        else:
+            metadata[key] = info[key]
+    body = b''.join(body)
+    digested = {
+        key: value for key, value in metadata.items()
+        if key not in UNDIGESTED_FIELDS
+    }
+    hash_ = hashlib.sha256(json.dumps(digested, sort_keys=True).encode('utf-8'))
+    hash_.update(body)
+    header = {
+        'format': FORMAT,
+        'version': VERSION,
+        'digest': hash_.hexdigest(),
+        'info': metadata,
+        'fields': fields,
+    }
+    with open(path, "wb") as file:
+        file.write(_encode(header))
+        file.write(body)
+
+
+def read(path):
+    """
+    Read the state of an article written by `write`, or in the older format
+    of a Python dictionary literal.  Raises `ValueError` if the file is in
+    neither format, and `OSError` if it can't be read.
+    """
+    with open(path, "rb") as file:
+        first = file.readline()
+        try:
+            header = json.loads(first)
+        except ValueError:
+            header = None
+        if isinstance(header, dict) and header.get('format') == FORMAT:
+            if header.get('version') != VERSION:
+                raise ValueError(f"unknown store version: {header.get('version')}")
+            return Record(path, header['info'], header['digest'],
+                          file.tell(), header['fields'])
+        contents = first + file.read()
+    try:
+        info = ast.literal_eval(contents.decode('utf-8').strip())
+    except SyntaxError as error:
+        raise ValueError(f"could not read store {path}") from error
+    if not isinstance(info, dict):
+        raise ValueError(f"could not read store {path}")
+    return Record(path, info, hashlib.sha256(contents).hexdigest())
@@ -1,3 +1,5 @@
+import copy
+
 import markdown
 from xml.etree import ElementTree as etree
 
@@ -36,3 +38,47 @@ class Extension(markdown.extensions.Extension):
         summariser = SummariseTreeprocessor(md)
         md.treeprocessors.register(summariser, 'summarise', 900)
         md.registerExtension(self)
+
+
+def _finish(md, root):
+    """The tree-processing and serialising tail of `markdown.Markdown.convert`."""
+    for treeprocessor in md.treeprocessors:
+        new_root = treeprocessor.run(root)
+        if new_root is not None:
+            root = new_root
+    output = md.serializer(root)
+    if md.stripTopLevelTags:
+        try:
+            start = output.index('<%s>' % md.doc_tag) + len(md.doc_tag) + 2
+            end = output.rindex('</%s>' % md.doc_tag)
+            output = output[start:end].strip()
+        except ValueError:
+            if output.strip().endswith('<%s />' % md.doc_tag):
+                output = ''
+            else:
+                raise
+    for postprocessor in md.postprocessors:
+        output = postprocessor.run(output)
+    return output.strip()
+
+
+def convert(md, source):
+    """
+    Convert the Markdown ``source`` using the instance ``md``, returning both
+    the full HTML and the HTML of its summary, while only running the
+    preprocessors and block parser once.  The summary is made by running
+    `SummariseTreeprocessor` and then the rest of ``md``'s tree processors over
+    a copy of the parsed tree, so it is the same as converting with a separate
+    instance that has this module's extension registered, provided ``md`` has
+    no extensions whose tree processors behave differently on the summary.
+    """
+    if not source.strip():
+        return '', ''
+    md.lines = source.split("\n")
+    for preprocessor in md.preprocessors:
+        md.lines = preprocessor.run(md.lines)
+    root = md.parser.parseDocument(md.lines).getroot()
+    summary_root = copy.deepcopy(root)
+    full = _finish(md, root)
+    summary_root = SummariseTreeprocessor(md).run(summary_root)
+    return full, _finish(md, summary_root)
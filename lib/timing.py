@@ -0,0 +1,164 @@
+"""
+Wall-time accounting for profiling builds.  Functions are wrapped in place,
+and the time spent in each is charged to its phase and to the unit of work (an
+article, a tag page, ...) that was running at the time.  Times are exclusive:
+time spent in instrumented calls nested inside another isn't counted again in
+the outer one.  Only calls made in this process are seen.
+"""
+
+import collections
+import functools
+import json
+import time
+
+__all__ = ['instrument', 'instrument_unit', 'restore', 'report', 'write_speedscope']
+
+# The phase charged with the time of a unit of work outside any other phase.
+OTHER = 'other'
+# The unit charged with time spent outside any unit of work.
+SITE = '(site)'
+
+# (unit, phase) -> [seconds, calls]
+_totals = collections.defaultdict(lambda: [0.0, 0])
+# One [phase, start time, seconds in nested phases] for each call in progress.
+_stack = []
+_unit = SITE
+# Opening and closing of phases and units, as (type, name, time).
+_events = []
+_patched = []
+
+
+def _timed(function, phase, label=None):
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        global _unit
+        unit = _unit
+        if label is not None:
+            _unit = label(*args, **kwargs)
+        name = phase if label is None else _unit
+        start = time.perf_counter()
+        frame = [phase, start, 0.0]
+        _stack.append(frame)
+        _events.append(('O', name, start))
+        try:
+            return function(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            _events.append(('C', name, end))
+            _stack.pop()
+            elapsed = end - start
+            totals = _totals[_unit, phase]
+            totals[0] += elapsed - frame[2]
+            totals[1] += 1
+            if _stack:
+                _stack[-1][2] += elapsed
+            _unit = unit
+    return timed
+
+
+def _get(owner, name):
+    return owner[name] if isinstance(owner, dict) else getattr(owner, name)
+
+
+def _set(owner, name, function):
+    if isinstance(owner, dict):
+        owner[name] = function
+    else:
+        setattr(owner, name, function)
+
+
+def instrument(owner, name, phase):
+    """
+    Time every call to the function ``owner.name`` (or ``owner[name]``, if
+    ``owner`` is a dict) as part of ``phase``.
+    """
+    function = _get(owner, name)
+    _set(owner, name, _timed(function, phase))
+    _patched.append((owner, name, function))
+
+
+def instrument_unit(owner, name, label):
+    """
+    Treat each call to the function ``owner.name`` as a unit of work, named by
+    calling ``label`` with the same arguments.
+    """
+    function = _get(owner, name)
+    _set(owner, name, _timed(function, OTHER, label))
+    _patched.append((owner, name, function))
+
+
+def restore():
+    """Undo all instrumentation, and forget everything recorded."""
+    global _unit
+    while _patched:
+        owner, name, function = _patched.pop()
+        _set(owner, name, function)
+    _totals.clear()
+    _stack.clear()
+    _events.clear()
+    _unit = SITE
+
+
+def _table(rows, phases):
+    width = max([len(SITE), *(len(unit) for unit in rows)])
+    yield f"{'':<{width}} {'total':>9}" + ''.join(f" {phase:>9}" for phase in phases)
+    for unit, seconds in rows.items():
+        yield (f"{unit:<{width}} {sum(seconds.values()):>9.3f}"
+               + ''.join(f" {seconds.get(phase, 0.0):>9.3f}" for phase in phases))
+
+
+def report(total, limit=20, file=None):
+    """
+    Print the time spent in each phase and the ``limit`` slowest units of
+    work.  ``total`` is the wall time of the whole run, to charge whatever
+    wasn't recorded to the site.
+    """
+    phases = collections.defaultdict(lambda: [0.0, 0])
+    units = collections.defaultdict(dict)
+    for (unit, phase), (seconds, calls) in _totals.items():
+        phases[phase][0] += seconds
+        phases[phase][1] += calls
+        units[unit][phase] = seconds
+    recorded = sum(seconds for seconds, _ in phases.values())
+    units[SITE][OTHER] = units[SITE].get(OTHER, 0.0) + total - recorded
+    phases[OTHER][0] += total - recorded
+    order = sorted(phases, key=lambda phase: (phase == OTHER, -phases[phase][0]))
+    print(f"{'phase':<12} {'seconds':>9} {'share':>6} {'calls':>8}", file=file)
+    for phase in order:
+        seconds, calls = phases[phase]
+        print(f"{phase:<12} {seconds:>9.3f} {seconds / total:>6.1%} {calls:>8}",
+              file=file)
+    print(f"{'total':<12} {total:>9.3f}", file=file)
+    slowest = sorted(units, key=lambda unit: -sum(units[unit].values()))
+    print(f"\nSlowest {min(limit, len(slowest))} of {len(slowest)} units of work:",
+          file=file)
+    for line in _table({unit: units[unit] for unit in slowest[:limit]}, order):
+        print(line, file=file)
+
+
+def write_speedscope(path, name):
+    """Write everything recorded as an evented profile for speedscope."""
+    frames = {}
+    events = []
+    for type_, frame, at in _events:
+        index = frames.setdefault(frame, len(frames))
+        events.append({'type': type_, 'frame': index, 'at': at})
+    start = _events[0][2] if _events else 0.0
+    for event in events:
+        event['at'] -= start
+    profile = {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'binhbar',
+        'shared': {'frames': [{'name': frame} for frame in frames]},
+        'profiles': [{
+            'type': 'evented',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0.0,
+            'endValue': events[-1]['at'] if events else 0.0,
+            'events': events,
+        }],
+    }
+    with open(path, "w") as file:
+        json.dump(profile, file)
@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+katex = pytest.importorskip('lib.katex', exc_type=ImportError)
+
+# Answers every request with something that isn't JSON, and stays alive.
+_GARBLED_SERVER = """\
+process.stdin.on('data', () => process.stdout.write('garbled\\n'));
+"""
+
+
+def _render_with_timeout(server, items, timeout=30):
+    outcome = {}
+
+    def render():
+        try:
+            outcome['result'] = server.render(items)
+        except OSError as error:
+            outcome['error'] = error
+
+    thread = threading.Thread(target=render, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "render() hung"
+    return outcome
+
+
+def test_garbled_output_fails_without_hanging(tmp_path, monkeypatch):
+    script = tmp_path / 'server.js'
+    script.write_text(_GARBLED_SERVER)
+    monkeypatch.setattr(katex, '_SERVER_SCRIPT', script)
+    server = katex.KaTeXServer()
+    try:
+        first = _render_with_timeout(server, [('x^2', True)])
+        assert 'error' in first
+        # The failed server is killed and reaped, not left running.
+        assert server._process is None
+        second = _render_with_timeout(server, [('y^2', True)])
+        assert 'error' in second
+    finally:
+        server.close()